@@ -0,0 +1,111 @@
+"""Request timing and SQL instrumentation shared by kanapi and tmsqlapi
+
+Each app times its requests with begin()/end(), in the request's own context, and has
+watch() count the SQL on its engine.  Nothing is registered unless the app turns
+metrics on.
+"""
+
+import bisect
+import contextvars
+import threading
+import time
+from sqlalchemy import event
+
+# Upper bounds of the histogram buckets
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENTS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 1000)
+BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+METRICS = {"request_duration_seconds": ("Request latency", SECONDS),
+           "request_sql_statements": ("SQL statements run per request", STATEMENTS),
+           "request_sql_seconds": ("Time spent running SQL per request", SECONDS),
+           "response_size_bytes": ("Response body size", BYTES)}
+
+
+class RequestStats:
+    """Running totals for the request being served"""
+    __slots__ = ("start", "sql_count", "sql_time")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+
+    def server_timing(self) -> str:
+        """Server-Timing header value for the request so far"""
+        return (f"app;dur={(time.perf_counter() - self.start) * 1000:.1f}, "
+                f"db;dur={self.sql_time * 1000:.1f};desc=\"{self.sql_count} queries\"")
+
+
+current = contextvars.ContextVar("apimetrics_request", default=None)
+
+
+class Metrics:
+    """Histograms per endpoint of latency, SQL statements, SQL time and response size"""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        # NOTE metric name -> (method, endpoint, status) -> [bucket counts..., sum, count]
+        self.histograms = {x: {} for x in METRICS}
+
+    def watch(self, engine):
+        """Count statements and the time they take on an engine, for the current request"""
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+    @staticmethod
+    def begin() -> RequestStats:
+        """Start timing a request"""
+        stats = RequestStats()
+        current.set(stats)
+        return stats
+
+    def end(self, stats: RequestStats, method: str, endpoint: str, status: int, size: int = None):
+        """Record a finished request, size is None if not known"""
+        current.set(None)
+        labels = (method, endpoint, str(status))
+        observations = {"request_duration_seconds": time.perf_counter() - stats.start,
+                        "request_sql_statements": stats.sql_count,
+                        "request_sql_seconds": stats.sql_time,
+                        "response_size_bytes": size}
+        with self.lock:
+            for name, value in observations.items():
+                if value is None:
+                    continue
+                bounds = METRICS[name][1]
+                histogram = self.histograms[name].setdefault(labels, [0] * (len(bounds) + 3))
+                histogram[bisect.bisect_left(bounds, value)] += 1
+                histogram[-2] += value
+                histogram[-1] += 1
+
+    def render(self) -> str:
+        """All histograms in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name, (description, bounds) in METRICS.items():
+                metric = f"{self.prefix}_{name}"
+                lines += [f"# HELP {metric} {description}", f"# TYPE {metric} histogram"]
+                for (method, endpoint, status), histogram in sorted(self.histograms[name].items()):
+                    labels = f'method="{method}",endpoint="{endpoint}",status="{status}"'
+                    cumulative = 0
+                    for bound, count in zip(bounds + ("+Inf",), histogram):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f"{metric}_sum{{{labels}}} {histogram[-2]}")
+                    lines.append(f"{metric}_count{{{labels}}} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def before_cursor_execute(conn, _cursor, _statement, _parameters, _context, _executemany):
+    """Note when a statement started"""
+    conn.info.setdefault("apimetrics_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, _cursor, _statement, _parameters, _context, _executemany):
+    """Add a finished statement to the current request"""
+    elapsed = time.perf_counter() - conn.info["apimetrics_start"].pop()
+    stats = current.get()
+    if stats:
+        stats.sql_count += 1
+        stats.sql_time += elapsed
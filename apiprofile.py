@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""Sampling profiler for slow requests, shared by kanapi and tmsqlapi
+
+A profiled request has its stacks sampled by a background thread until it ends.  If it
+took longer than the threshold, or the client asked for it with an X-Profile header,
+the samples are saved as a JSON file in a directory that keeps only the newest ones.
+
+Run to list the saved profiles or show one, e.g. ./apiprofile.py show
+"""
+
+import argparse
+import collections
+import datetime
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+HEADER = "X-Profile"
+ID_HEADER = "X-Profile-Id"
+PROFILE_DIR = "profiles"
+
+# Innermost frames of threads waiting for work, these are not sampled
+IDLE = {("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"),
+        ("queue.py", "get"), ("selectors.py", "select"), ("socketserver.py", "serve_forever")}
+
+
+@functools.cache
+def label(code) -> str:
+    """Frame name as py-spy writes it: function (file:line)"""
+    file_name = code.co_filename
+    if "site-packages" in file_name:
+        file_name = file_name.split("site-packages" + os.sep, 1)[-1]
+    else:
+        file_name = os.path.basename(file_name)
+    return f"{code.co_qualname} ({file_name}:{code.co_firstlineno})"
+
+
+class Profile:
+    """Stack samples of one request, taken every interval until stop()"""
+    samplers = set()  # NOTE sampler threads never sample each other
+
+    def __init__(self, forced: bool, thread_id: int = None, interval: float = 0.001):
+        """Sample thread thread_id, or every busy thread if None"""
+        self.id = f"{datetime.datetime.now():%Y%m%d-%H%M%S-%f}-{os.getpid()}"
+        self.forced = forced
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.start = time.perf_counter()
+        self.stopping = threading.Event()
+        self.sampler = threading.Thread(target=self.run, daemon=True)
+        self.sampler.start()
+
+    def run(self):
+        """Sample until stopped"""
+        Profile.samplers.add(threading.get_ident())
+        try:
+            while not self.stopping.wait(self.interval):
+                self.sample()
+        finally:
+            Profile.samplers.discard(threading.get_ident())
+
+    def sample(self):
+        """Count the current stack of each sampled thread, root first"""
+        frames = sys._current_frames()  # pylint: disable=protected-access
+        if self.thread_id is not None:
+            frames = {self.thread_id: frames.get(self.thread_id)}
+        for ident, frame in frames.items():
+            if frame is None or ident in Profile.samplers:
+                continue
+            if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE:
+                continue
+            stack = []
+            while frame:
+                stack.append(label(frame.f_code))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def stop(self) -> float:
+        """Stop sampling, return how long the request took"""
+        duration = time.perf_counter() - self.start
+        self.stopping.set()
+        self.sampler.join()
+        return duration
+
+
+class Profiler:
+    """Decides which requests to profile and keeps the slow ones in directory"""
+
+    def __init__(self, directory: str = PROFILE_DIR, rate: float = 0.0, header: bool = False,
+                 threshold: float = 0.1, keep: int = 100, interval: float = 0.001):
+        """Profile a rate fraction of requests and, if header, those with X-Profile
+
+        Sampled requests faster than threshold seconds are not kept, those asked for with
+        the header always are.  Only the newest keep profiles stay in directory.
+        """
+        self.directory = directory
+        self.rate = rate
+        self.header = header
+        self.threshold = threshold
+        self.keep = keep
+        self.interval = interval
+
+    @property
+    def enabled(self) -> bool:
+        """Whether any request can be profiled"""
+        return bool(self.rate or self.header)
+
+    def begin(self, forced: bool, thread_id: int = None) -> Profile | None:
+        """Start profiling a request if asked for (forced) or sampled, else None"""
+        forced = forced and self.header
+        if not forced and not (self.rate and random.random() < self.rate):
+            return None
+        return Profile(forced, thread_id, self.interval)
+
+    def end(self, profile: Profile, method: str, path: str, endpoint: str,
+            status: int) -> str | None:
+        """Stop profiling a request, save it if forced or slow, return the file name"""
+        duration = profile.stop()
+        if not profile.forced and duration < self.threshold:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        file_name = os.path.join(self.directory, f"{profile.id}.json")
+        with open(file_name + ".tmp", "w", encoding="utf-8") as profile_file:
+            json.dump({"id": profile.id,
+                       "method": method,
+                       "path": path,
+                       "endpoint": endpoint,
+                       "status": status,
+                       "duration": duration,
+                       "forced": profile.forced,
+                       "interval": profile.interval,
+                       "samples": profile.samples,
+                       "stacks": profile.stacks}, profile_file)
+        os.replace(file_name + ".tmp", file_name)
+        for old in profile_ids(self.directory)[:-self.keep]:
+            try:
+                os.remove(os.path.join(self.directory, f"{old}.json"))
+            except FileNotFoundError:
+                pass  # NOTE another worker pruned it first
+        return file_name
+
+
+def profile_ids(directory: str) -> list[str]:
+    """IDs of the profiles saved in directory, oldest first"""
+    try:
+        return sorted(x[:-5] for x in os.listdir(directory) if x.endswith(".json"))
+    except FileNotFoundError:
+        return []
+
+
+def load(directory: str, profile_id: str = None) -> dict:
+    """Profile with the given ID, or unique ID prefix, or the newest one"""
+    ids = [x for x in profile_ids(directory) if x.startswith(profile_id or "")]
+    if not ids or (profile_id and len(ids) > 1 and profile_id not in ids):
+        sys.exit(f"No {'unique ' if ids else ''}profile {profile_id or ''} in {directory}")
+    profile_id = profile_id if profile_id in ids else ids[-1]
+    with open(os.path.join(directory, f"{profile_id}.json"), encoding="utf-8") as profile_file:
+        return json.load(profile_file)
+
+
+def top(stacks: dict, count: int, by_total: bool = False) -> list[tuple[str, int, int]]:
+    """The count functions with the most samples of their own, or in and under them
+
+    Returned as (function, own samples, total samples)
+    """
+    own = collections.Counter()
+    total = collections.Counter()
+    for stack, samples in stacks.items():
+        frames = stack.split(";")
+        own[frames[-1]] += samples
+        for frame in set(frames):
+            total[frame] += samples
+    return [(x, own[x], total[x]) for x, _ in (total if by_total else own).most_common(count)]
+
+
+def list_profiles(directory: str):
+    """Print a line per saved profile, oldest first"""
+    for profile_id in profile_ids(directory):
+        try:
+            profile = load(directory, profile_id)
+        except FileNotFoundError:
+            continue
+        print(f"{profile_id} {profile['duration'] * 1000:9.1f}ms {profile['samples']: >6} "
+              f"{profile['status']} {profile['method']} {profile['path']}")
+
+
+def show_profile(directory: str, profile_id: str, count: int, by_total: bool, match: str):
+    """Print the functions with the most samples, as a share of the samples taken"""
+    profile = load(directory, profile_id)
+    stacks = {k: v for k, v in profile["stacks"].items() if match in k}
+    taken = max(1, profile["samples"])
+    print(f"{profile['id']} {profile['method']} {profile['path']} ({profile['endpoint']}) "
+          f"{profile['status']} {profile['duration'] * 1000:.1f}ms, "
+          f"{profile['samples']} samples every {profile['interval'] * 1000:g}ms")
+    print(f"{'own': >6} {'total': >6}")
+    for function, own, total in top(stacks, count, by_total):
+        print(f"{own * 100 / taken:5.1f}% {total * 100 / taken:5.1f}% {function}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--directory", default=PROFILE_DIR,
+                        help="Where the API saves profiles, its profile_dir/PROFILE_DIR")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List saved profiles, oldest first")
+    show = subparsers.add_parser("show", help="Show where a profile spent its time")
+    show.add_argument("id", nargs="?", help="Profile ID or ID prefix, default the newest")
+    show.add_argument("-n", "--count", type=int, default=25, help="Functions to show")
+    show.add_argument("-t", "--total", action="store_true",
+                      help="Order by time in and under a function instead of by own time")
+    show.add_argument("-m", "--match", default="",
+                      help="Only count stacks containing this, e.g. a function name")
+    show.add_argument("-c", "--collapsed", action="store_true",
+                      help="Print collapsed stacks for flamegraph.pl, speedscope etc.")
+    cargs = parser.parse_args()
+    if cargs.command == "list":
+        list_profiles(cargs.directory)
+    elif cargs.collapsed:
+        for stack, samples in load(cargs.directory, cargs.id)["stacks"].items():
+            if cargs.match in stack:
+                print(stack, samples)
+    else:
+        show_profile(cargs.directory, cargs.id, cargs.count, cargs.total, cargs.match)
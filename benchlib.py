@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Shared helpers for kanbench and tmbench: synthetic data, latency statistics and JSON results
+
+Run with two result files to compare them, e.g. ./benchlib.py before.json after.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+
+WORDS = ["buy", "call", "fix", "email", "plan", "review", "book", "clean", "pay", "write",
+         "milk", "car", "taxes", "dentist", "garden", "report", "budget", "flights", "garage",
+         "invoice", "mom", "boss", "team", "roof", "laptop", "kitchen", "bank", "school"]
+
+
+def percentile(timings: list[float], fraction: float) -> float:
+    """Nearest rank percentile of sorted timings"""
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def summary(timings: list[float], wall: float = None) -> dict:
+    """Latency percentiles in milliseconds, and requests per second over wall (or their sum)"""
+    timings = sorted(timings)
+    return {"n": len(timings),
+            "p50": percentile(timings, 0.5) * 1000,
+            "p95": percentile(timings, 0.95) * 1000,
+            "p99": percentile(timings, 0.99) * 1000,
+            "max": timings[-1] * 1000,
+            "rps": len(timings) / (wall or sum(timings))}
+
+
+def report(name: str, timings: list[float], wall: float = None) -> dict:
+    """Print latency summary in milliseconds, return it as from summary()"""
+    stats = summary(timings, wall)
+    print(f"{name: <32} n={stats['n']: <6} "
+          f"p50={stats['p50']:7.2f}ms "
+          f"p95={stats['p95']:7.2f}ms "
+          f"p99={stats['p99']:7.2f}ms "
+          f"max={stats['max']:7.2f}ms "
+          f"{stats['rps']:8.1f}/s")
+    return stats
+
+
+def timed(name: str, calls: int, call) -> dict:
+    """Run call(i) calls times and report on it"""
+    timings = []
+    begin = time.perf_counter()
+    for i in range(calls):
+        start = time.perf_counter()
+        call(i)
+        timings.append(time.perf_counter() - start)
+    return report(name, timings, time.perf_counter() - begin)
+
+
+def per_row(name: str, rows: int, calls: int, call) -> float:
+    """Run call(i) calls times, print the median in milliseconds and per row in microseconds
+
+    Returns the cost per row in microseconds
+    """
+    timings = []
+    for i in range(calls):
+        start = time.perf_counter()
+        call(i)
+        timings.append(time.perf_counter() - start)
+    median = percentile(sorted(timings), 0.5)
+    print(f"{name: <32} rows={rows: <7} p50={median * 1000:8.2f}ms "
+          f"{median / rows * 1e6:7.2f}us/row")
+    return median / rows * 1e6
+
+
+def commit() -> str | None:
+    """Current git commit of this tree, with a + if it has changes"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        head = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True, cwd=here).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               capture_output=True, text=True, check=True,
+                               cwd=here).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return head + ("+" if dirty else "")
+
+
+def save(file_name: str, suite: str, results: dict, **params):
+    """Write results ({size: {endpoint: summary}}) with enough context to compare runs"""
+    with open(file_name, "w", encoding="utf-8") as results_file:
+        json.dump({"suite": suite,
+                   "commit": commit(),
+                   "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "python": platform.python_version(),
+                   "params": params,
+                   "results": results}, results_file, indent=1)
+
+
+def compare(old_file: str, new_file: str, stat: str = "p50"):
+    """Print one stat for each endpoint in two result files, and the ratio new/old"""
+    with open(old_file, encoding="utf-8") as results_file:
+        old = json.load(results_file)
+    with open(new_file, encoding="utf-8") as results_file:
+        new = json.load(results_file)
+    print(f"{stat} ms {old['commit']} -> {new['commit']}")
+    for size, endpoints in new["results"].items():
+        for endpoint, stats in endpoints.items():
+            before = old["results"].get(size, {}).get(endpoint)
+            if not before:
+                print(f"{size: >8} {endpoint: <32} {'': >9} {stats[stat]:9.2f}")
+                continue
+            print(f"{size: >8} {endpoint: <32} {before[stat]:9.2f} {stats[stat]:9.2f} "
+                  f"{stats[stat] / before[stat]:6.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--stat", choices=["p50", "p95", "p99", "max", "rps"],
+                        default="p50")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    cargs = parser.parse_args()
+    compare(cargs.old, cargs.new, cargs.stat)
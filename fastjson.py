@@ -0,0 +1,51 @@
+"""Fast JSON responses for long lists, shared by kanapi and tmsqlapi
+
+Endpoints that return many rows select plain columns rather than ORM objects, turn each
+result tuple straight into a dict and encode the lot with orjson (the json module if
+orjson is not installed), skipping Pydantic validation and flask_restx marshalling.
+"""
+
+import datetime
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(value):
+    """Encode what the json module can't, as orjson and the models do"""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(value) -> bytes:
+    """Compact UTF-8 JSON, dates and datetimes in ISO 8601"""
+    if orjson:
+        return orjson.dumps(value)
+    return json.dumps(value, default=default, ensure_ascii=False,
+                      separators=(",", ":")).encode()
+
+
+def records(keys, rows) -> list[dict]:
+    """Result tuples as dicts of keys, e.g. result.keys()
+
+    NOTE several times cheaper per row than Row._asdict()
+    """
+    keys = tuple(keys)
+    return [dict(zip(keys, x)) for x in rows]
+
+
+class FastJSON:
+    """Mixin for a framework's Response class, to encode the content with dumps()
+
+    Works with both Starlette's (kanapi) and werkzeug's (tmsqlapi) Response, e.g.
+    class FastJSONResponse(fastjson.FastJSON, flask.Response)
+    """
+    media_type = "application/json"  # NOTE Starlette
+    default_mimetype = "application/json"  # NOTE werkzeug
+
+    def __init__(self, content, *args, **kwargs):
+        super().__init__(dumps(content), *args, **kwargs)
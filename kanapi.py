@@ -1,14 +1,87 @@
 """KanBan API and DataBase"""
 
+import asyncio
 import datetime
+import hashlib
+import json
+import os
+import re
+import threading
 from typing import Optional
-from fastapi import FastAPI, Depends, HTTPException
-from sqlmodel import Field, SQLModel, Session, create_engine, Relationship, select
+from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy import (Index, and_, case, column, event, inspect, or_, table, text, update,
+                        make_url)
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Field, SQLModel, Session, create_engine, Relationship, select, func
+from sqlmodel.ext.asyncio.session import AsyncSession
+import apimetrics
+import apiprofile
+import fastjson
 
 SQLITE_FILE = 'kanban.test.db'
 SQLITE_URL = f"sqlite:///{SQLITE_FILE}"
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
 MIN_ORDER = 1
 MAX_ORDER = 2147483646
+RENUMBER_WINDOW = 8
+RENUMBER_GAP = 1024
+STREAM_CHUNK = 500
+EVENT_KEEPALIVE = 15
+EVENT_BACKLOG = 1000
+# Full text index over card names, kept in sync by triggers (SQLite FTS5 only)
+SEARCH_DDL = ["CREATE VIRTUAL TABLE card_fts USING fts5(card_name, content='card', "
+              "content_rowid='card_id')",
+              "CREATE TRIGGER card_fts_insert AFTER INSERT ON card BEGIN "
+              "INSERT INTO card_fts(rowid, card_name) VALUES (new.card_id, new.card_name); END",
+              "CREATE TRIGGER card_fts_delete AFTER DELETE ON card BEGIN "
+              "INSERT INTO card_fts(card_fts, rowid, card_name) "
+              "VALUES ('delete', old.card_id, old.card_name); END",
+              "CREATE TRIGGER card_fts_update AFTER UPDATE OF card_name ON card BEGIN "
+              "INSERT INTO card_fts(card_fts, rowid, card_name) "
+              "VALUES ('delete', old.card_id, old.card_name); "
+              "INSERT INTO card_fts(rowid, card_name) VALUES (new.card_id, new.card_name); END",
+              "INSERT INTO card_fts(card_fts) VALUES ('rebuild')"]
+card_fts = table("card_fts", column("rowid"), column("rank"), column("card_fts"))
+
+class Settings(SQLModel):
+    """Database settings
+
+    Read from the JSON file named by KANAPI_SETTINGS, then overridden by environment
+    variables named KANAPI_ plus the upper case field name, e.g. KANAPI_DATABASE_URL.
+    sqlite_ settings are PRAGMAs set on each new SQLite connection; None leaves the
+    SQLite default.
+    """
+    database_url: str = SQLITE_URL
+    async_reads: bool = False  # serve read only endpoints from aiosqlite/asyncpg
+    echo: bool = False
+    pool_size: Optional[int] = None
+    max_overflow: Optional[int] = None
+    sqlite_journal_mode: Optional[str] = "WAL"
+    sqlite_synchronous: Optional[str] = "NORMAL"
+    sqlite_busy_timeout: Optional[int] = 5000
+    sqlite_mmap_size: Optional[int] = None
+    sqlite_cache_size: Optional[int] = None
+    metrics: bool = False  # time requests and count their SQL, see /metrics and Server-Timing
+    profile_rate: float = 0.0  # fraction of requests to profile, see apiprofile
+    profile_header: bool = False  # profile requests sent with an X-Profile header
+    profile_threshold: float = 0.1  # seconds, faster sampled requests are not kept
+    profile_dir: str = apiprofile.PROFILE_DIR
+    profile_keep: int = 100  # newest profiles kept in profile_dir
+
+def load_settings() -> Settings:
+    """Settings from KANAPI_SETTINGS file and KANAPI_* environment variables"""
+    values = {}
+    if os.environ.get('KANAPI_SETTINGS'):
+        with open(os.environ['KANAPI_SETTINGS'], encoding='utf-8') as settings_file:
+            values.update(json.load(settings_file))
+    for field in Settings.model_fields:
+        if f'KANAPI_{field.upper()}' in os.environ:
+            values[field] = os.environ[f'KANAPI_{field.upper()}']
+    return Settings.model_validate(values)
 
 class Category(SQLModel, table=True):
     """A type of card with a given color, similar to a context"""
@@ -16,12 +89,15 @@ class Category(SQLModel, table=True):
     category_name: str
     category_color: Optional[str] = None
 
-class Board(SQLModel, table=True):
+class BoardBase(SQLModel):
     """A KanBan board with lists on it"""
-    board_id: int = Field(primary_key = True)
     user: Optional[str] = None
     category_id: Optional[int] = Field(default=None, foreign_key="category.category_id")
 
+class Board(BoardBase, table=True):
+    """A table of boards"""
+    board_id: int | None = Field(primary_key=True, default=None)
+
 class ListBase(SQLModel):
     """A list of cards that may be on a Board"""
     list_name: str
@@ -37,7 +113,11 @@ class ListBase(SQLModel):
 
 class List(ListBase, table=True):
     """A table of lists"""
+    __table_args__ = (Index("ix_list_list_closed", "list_closed"),
+                      Index("ix_list_board_id_board_order", "board_id", "board_order"),
+                      Index("ix_list_list_wakeup", "list_wakeup"))
     list_id: int | None = Field(primary_key=True, default=None)
+    list_version: int = 0  # NOTE bumped whenever the list or its cards change, see lists_etag()
     cards: list["Card"] = Relationship(back_populates="list_")
 
 
@@ -62,6 +142,10 @@ class CardPatch(SQLModel):
 
 class Card(CardBase, table=True):
     """An index card or task"""
+    __table_args__ = (Index("ix_card_list_id_list_order", "list_id", "list_order"),
+                      # NOTE not partial, move_list moves closed cards too
+                      Index("ix_card_category_id_list_id", "category_id", "list_id"),
+                      Index("ix_card_card_closed", "card_closed"))
     card_id: int = Field(primary_key = True)
     list_id: int = Field(foreign_key="list.list_id")
     list_: List = Relationship(back_populates="cards")
@@ -80,15 +164,16 @@ class CardMove(SQLModel):
 
 class ListMove(SQLModel):
     """A request to split/merge/move a list"""
-    # TODO add selectors to split part of list
-    # TODO something to control whether we go to front or back of dest list
+    # TODO add more selectors to split part of list
     list_id: Optional[int] = None  # NOTE this is the destination list
     category_id: Optional[int] = None  # NOTE this will filter the items
-    delete: Optional[bool] = False
+    delete: Optional[bool] = False  # NOTE delete the source list, which must end up empty
+    front: Optional[bool] = False  # NOTE put cards at the front of the dest list, not the back
 
 class ListMoveResult(SQLModel):
     """Result of moving a list"""
     success: Optional[bool] = True
+    moved: int = 0
 
 class CardClose(SQLModel):
     """A request to close a card"""
@@ -97,79 +182,512 @@ class CardClose(SQLModel):
 class ListWithCards(ListBase):
     """A list that includes details of cards on it"""
     list_id: int
+    list_version: int = 0  # NOTE lets clients such as kanlocal see which lists changed
     cards: list[CardWithoutList] = []
 
-connect_args = {"check_same_thread": False}
-engine = create_engine(SQLITE_URL, echo=True, connect_args=connect_args)
+CARD_FIELDS = list(CardWithoutList.model_fields)
+CARD_COLUMNS = [Card.__table__.c[x] for x in CARD_FIELDS]
+
+class FastJSONResponse(fastjson.FastJSON, Response):
+    """JSON response encoded with orjson, for content already in the response model's shape"""
+
+class BoardWithLists(BoardBase):
+    """A board with all its lists and their cards"""
+    board_id: int
+    lists: list[ListWithCards] = []
+
+class ChangeEvent(SQLModel):
+    """A change to cards or lists, as published on /events"""
+    # card_created, card_moved, card_closed, card_patched, list_merged or resync; resync
+    # means events were dropped for a slow subscriber, which should reload and reconnect
+    event: str
+    list_ids: list[int]
+    card: Optional[CardWithoutList] = None
+
+class ChangeFeed:
+    """Fan out change events from the (threadpool) endpoints to /events subscribers"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+    def subscribe(self, list_ids: set[int] = None) -> asyncio.Queue:
+        """Register a queue for events touching any of list_ids (or all events)"""
+        queue = asyncio.Queue(maxsize=EVENT_BACKLOG)
+        with self.lock:
+            self.subscribers[queue] = (asyncio.get_running_loop(), list_ids)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        """Stop sending events to a queue"""
+        with self.lock:
+            self.subscribers.pop(queue, None)
+
+    def publish(self, event: ChangeEvent):
+        """Send an event to each interested subscriber; call only after commit"""
+        with self.lock:
+            subscribers = list(self.subscribers.items())
+        for queue, (loop, list_ids) in subscribers:
+            if list_ids and not list_ids.intersection(event.list_ids):
+                continue
+            loop.call_soon_threadsafe(self.offer, queue, event)
+
+    def offer(self, queue: asyncio.Queue, event: ChangeEvent):
+        """Queue an event (in the subscriber's loop); a full queue gets only a resync event
+
+        The subscriber is dropped then, so a stalled client can't hold unbounded events
+        """
+        with self.lock:
+            if queue not in self.subscribers:
+                return
+            if queue.full():
+                del self.subscribers[queue]
+        if queue.full():
+            while not queue.empty():
+                queue.get_nowait()
+            event = ChangeEvent(event="resync", list_ids=[])
+        queue.put_nowait(event)
+
+change_feed = ChangeFeed()
+
+def async_url(url: str):
+    """The async driver equivalent of a (sync) database URL"""
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+def set_sqlite_pragmas(engine_, settings: Settings):
+    """Apply the sqlite_ settings to every new connection of an engine"""
+    pragmas = {x.removeprefix("sqlite_"): getattr(settings, x)
+               for x in Settings.model_fields
+               if x.startswith("sqlite_") and getattr(settings, x) is not None}
+    if not pragmas:
+        return
+
+    @event.listens_for(engine_, "connect")
+    def connect(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+def create_engines(settings: Settings) -> tuple:
+    """Create the sync engine, and the async engine if async_reads is set"""
+    kwargs = {"echo": settings.echo}
+    if settings.pool_size is not None:
+        kwargs["pool_size"] = settings.pool_size
+    if settings.max_overflow is not None:
+        kwargs["max_overflow"] = settings.max_overflow
+    sqlite = make_url(settings.database_url).get_backend_name() == "sqlite"
+    connect_args = {"check_same_thread": False} if sqlite else {}
+    engine_ = create_engine(settings.database_url, connect_args=connect_args, **kwargs)
+    async_engine_ = None
+    if settings.async_reads:
+        async_engine_ = create_async_engine(async_url(settings.database_url), **kwargs)
+    if sqlite:
+        set_sqlite_pragmas(engine_, settings)
+        if async_engine_:
+            set_sqlite_pragmas(async_engine_.sync_engine, settings)
+    if settings.metrics:
+        metrics.watch(engine_)
+        if async_engine_:
+            metrics.watch(async_engine_.sync_engine)
+    return engine_, async_engine_
+
+metrics = apimetrics.Metrics("kanapi")
+settings = load_settings()
+engine, async_engine = create_engines(settings)
+profiler = apiprofile.Profiler(settings.profile_dir, settings.profile_rate,
+                               settings.profile_header, settings.profile_threshold,
+                               settings.profile_keep)
+
+# Columns added to existing tables since the schema was first released, and their DDL
+ADDED_COLUMNS = {("list", "list_version"): "INTEGER NOT NULL DEFAULT 0"}
 
 def create_db_and_tables():
-    """Create DB schema"""
+    """Create DB schema
+
+    Also migrates an existing DB: columns in ADDED_COLUMNS and indexes added since it was
+    created get added
+    """
     SQLModel.metadata.create_all(engine)
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for (table_name, column_name), definition in ADDED_COLUMNS.items():
+            if column_name not in {x["name"] for x in inspector.get_columns(table_name)}:
+                connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} "
+                                        f"{definition}"))
+        for table_ in SQLModel.metadata.sorted_tables:
+            for index in table_.indexes:
+                index.create(connection, checkfirst=True)
+        if engine.dialect.name == "sqlite" and not inspector.has_table("card_fts"):
+            for ddl in SEARCH_DDL:
+                connection.execute(text(ddl))
 
 app = FastAPI(
         title="TaskMaster KanBan API"
         )
 
+class MetricsMiddleware:
+    """Record each request in metrics and add a Server-Timing header
+
+    For streamed responses the header covers the time to the first byte
+    """
+
+    def __init__(self, app_):
+        self.app = app_
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = metrics.begin()
+        status = 500
+        size = 0
+
+        async def send_timed(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", []),
+                                      (b"server-timing", stats.server_timing().encode())]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            route = scope.get("route")
+            metrics.end(stats, scope["method"], route.path if route else "unmatched",
+                        status, size)
+
+if settings.metrics:
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/metrics", include_in_schema=False)
+    def get_metrics():
+        """Request metrics in the Prometheus text format"""
+        return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+class ProfileMiddleware:
+    """Profile requests that are sampled or sent with X-Profile, keep the slow ones
+
+    Samples every busy thread, as sync endpoints and their response validation run in
+    the threadpool, so other requests running at the same time can show up too
+    """
+
+    def __init__(self, app_):
+        self.app = app_
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        header = apiprofile.HEADER.lower().encode()
+        profile = profiler.begin(any(x == header for x, _ in scope["headers"]))
+        if not profile:
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_profiled(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if profile.forced:
+                    message["headers"] = [*message.get("headers", []),
+                                          (apiprofile.ID_HEADER.lower().encode(),
+                                           profile.id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            route = scope.get("route")
+            profiler.end(profile, scope["method"], scope["path"],
+                         route.path if route else "unmatched", status)
+
+if profiler.enabled:
+    app.add_middleware(ProfileMiddleware)
+
 def get_session():
     """Get a DB session"""
     with Session(engine) as session:
         yield session
 
+async def get_read_session():
+    """Get a DB session for read only endpoints, an AsyncSession if async_reads is set"""
+    if async_engine is None:
+        with Session(engine) as session:
+            yield session
+    else:
+        async with AsyncSession(async_engine) as session:
+            yield session
+
+async def read_all(session: Session | AsyncSession, statement) -> list:
+    """Run a select on either kind of session without blocking the event loop"""
+    if isinstance(session, AsyncSession):
+        return (await session.exec(statement)).all()
+    return await run_in_threadpool(lambda: session.exec(statement).all())
+
+async def read_get(session: Session | AsyncSession, model: type, ident: int):
+    """Get a row by primary key on either kind of session without blocking the event loop"""
+    if isinstance(session, AsyncSession):
+        return await session.get(model, ident)
+    return await run_in_threadpool(session.get, model, ident)
+
 
 @app.on_event("startup")
 def on_startup():
     """Startup of app function that ensures schema creation"""
     create_db_and_tables()
 
-def generate_list_order(existing: list[Card], before: int = None, after: int = None) -> int:
-    """Propose a list_order for a new or existing card based on existing items in the list"""
-    # NOTE This may be overly complicated
+def list_order_neighbour(session: Session, list_id: int, order: int = None,
+                         below: bool = True, exclude: int = None) -> int:
+    """Nearest list_order below/above order in a list (or the last/first if no order)
+
+    Uses the (list_id, list_order) index rather than loading the list
+    """
+    if below:
+        statement = select(func.max(Card.list_order)).where(Card.list_id == list_id)
+        if order is not None:
+            statement = statement.where(Card.list_order < order)
+    else:
+        statement = select(func.min(Card.list_order)).where(Card.list_id == list_id)
+        if order is not None:
+            statement = statement.where(Card.list_order > order)
+    if exclude:
+        statement = statement.where(Card.card_id != exclude)
+    return session.exec(statement).one()
+
+def renumber_list_window(session: Session, list_id: int, low: int = None, high: int = None,
+                         count: int = 1, exclude: int = None) -> list[int]:
+    """Make room for count cards between orders low and high by renumbering neighbours
+
+    Spreads the cards nearest the exhausted gap evenly over a window that doubles until
+    they can be RENUMBER_GAP apart, then writes them back in a single UPDATE.  Returns the
+    new orders.
+    """
+    window = RENUMBER_WINDOW
+    selected = [Card.list_id == list_id]
+    if exclude:
+        selected.append(Card.card_id != exclude)
+    while True:
+        lower_orders = []
+        upper_orders = []
+        if low is not None:
+            lower_orders = session.exec(select(Card.list_order)
+                                        .where(*selected, Card.list_order <= low)
+                                        .order_by(Card.list_order.desc())
+                                        .limit(window + 1)).all()
+        if high is not None:
+            upper_orders = session.exec(select(Card.list_order)
+                                        .where(*selected, Card.list_order >= high)
+                                        .order_by(Card.list_order)
+                                        .limit(window + 1)).all()
+        floor = lower_orders[window] if len(lower_orders) > window else MIN_ORDER - 1
+        ceiling = upper_orders[window] if len(upper_orders) > window else MAX_ORDER + 1
+        lower_count = len([x for x in lower_orders[:window] if x > floor])
+        upper_count = len([x for x in upper_orders[:window] if x < ceiling])
+        step = int((ceiling - floor) / (lower_count + count + upper_count + 1))
+        whole_list = len(lower_orders) <= window and len(upper_orders) <= window
+        if step >= RENUMBER_GAP or (whole_list and step >= 1):
+            break
+        assert not whole_list  # list is full
+        window *= 2
+    in_window = []
+    if low is not None:
+        in_window.append(and_(Card.list_order > floor, Card.list_order <= low))
+    if high is not None:
+        in_window.append(and_(Card.list_order >= high, Card.list_order < ceiling))
+    if in_window:
+        ranked = select(Card.card_id,
+                        Card.list_order,
+                        func.row_number().over(order_by=(Card.list_order, Card.card_id))
+                        .label("card_rank")).where(*selected, or_(*in_window)).subquery()
+        # Cards above the gap skip over the count slots left for the new cards
+        slots_before = ranked.c.card_rank
+        if high is not None:
+            slots_before = ranked.c.card_rank + case((ranked.c.list_order >= high, count),
+                                                     else_=0)
+        session.exec(update(Card)
+                     .where(Card.card_id == ranked.c.card_id)
+                     .values(list_order=floor + step * slots_before)
+                     .execution_options(synchronize_session=False))
+    return [floor + step * (lower_count + x + 1) for x in range(count)]
+
+def free_list_orders(session: Session, list_id: int, low: int = None, high: int = None,
+                     count: int = 1, exclude: int = None) -> list[int]:
+    """Propose count evenly spaced list_orders strictly between low and high
+
+    None for low/high means the start/end of the list.  If the gap is exhausted the
+    neighbouring cards get renumbered to make room.
+    """
+    floor = MIN_ORDER - 1 if low is None else low
+    ceiling = MAX_ORDER + 1 if high is None else high
+    step = int((ceiling - floor) / (count + 1))
+    if step < 1:
+        return renumber_list_window(session, list_id, low, high, count, exclude)
+    return [floor + step * (x + 1) for x in range(count)]
+
+def generate_list_order(session: Session, list_id: int, before: int = None, after: int = None,
+                        exclude: int = None) -> int:
+    """Propose a list_order for a new or existing card in a list
+
+    Only the neighbours of the target position are looked up.  Pass the card being moved
+    as exclude so its current position is ignored.
+    """
     assert not (before and after)
-    existing_orders = sorted({x.list_order for x in existing if x.list_order is not None})
-    if not existing_orders:
-        # If no existing orders, just put it in the middle
-        return int((MIN_ORDER + MAX_ORDER)/2)
-    if not before and not after:
-        # If no preference has been given, just put it at the end
-        return int((max(existing_orders) + MAX_ORDER)/2)
     target_id = before if before else after
-    target_cards = [x for x in existing if x.card_id == target_id]
-    assert len(target_cards) == 1
-    target_card = target_cards[0]
-    target_order = target_card.list_order
+    target_order = None
+    if target_id:
+        target_card = session.get(Card, target_id)
+        assert target_card and target_card.list_id == list_id
+        target_order = target_card.list_order
+    low = None
+    high = None
     if target_order is None:
-        # If the card we want to go before/after doesn't have an order,
-        #   just put at beginning or end
+        # If no preference has been given, or the card we want to go before/after doesn't
+        #   have an order, just put at beginning or end
         if before:
-            return int((min(existing_orders) + MIN_ORDER)/2)
-        return int((max(existing_orders) + MAX_ORDER)/2)
-    # Finally, if we can find our rightful place, insert appropriately,
-    #   careful to take into account we may be first or last
-    target_place = existing_orders.index(target_order)
-    if before:
-        if target_place == 0:
-            return int((MIN_ORDER + target_order)/2)
-        return int((existing_orders[target_place-1] + target_order)/2)
-    if target_place == len(existing_orders) - 1:
-        return int((MAX_ORDER + target_order)/2)
-    return int((existing_orders[target_place+1] + target_order)/2)
-
-def card_list_order(card: Card) -> int:
-    """Given a card, return the order; safe for sorting"""
-    if not card.list_order:
-        return 0
-    return card.list_order
+            high = list_order_neighbour(session, list_id, below=False, exclude=exclude)
+        else:
+            low = list_order_neighbour(session, list_id, exclude=exclude)
+    elif before:
+        high = target_order
+        low = list_order_neighbour(session, list_id, target_order, exclude=exclude)
+    else:
+        low = target_order
+        high = list_order_neighbour(session, list_id, target_order, below=False, exclude=exclude)
+    return free_list_orders(session, list_id, low, high, exclude=exclude)[0]
+
+def bump_list_version(session: Session, *list_ids: int):
+    """Mark lists as changed so clients holding an old ETag refetch them"""
+    session.exec(update(List)
+                 .where(List.list_id.in_({x for x in list_ids if x}))
+                 .values(list_version=List.list_version + 1))
+
+def lists_etag(lists: list[List], variant: str = "") -> str:
+    """Strong ETag for a representation of some lists, based on their versions"""
+    if len(lists) == 1:
+        return f'"list-{lists[0].list_id}-{lists[0].list_version}{variant}"'
+    digest = hashlib.sha1(repr([(x.list_id, x.list_version) for x in lists]).encode())
+    return f'"lists-{digest.hexdigest()}{variant}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the client's If-None-Match already has this ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in [x.strip().removeprefix("W/") for x in if_none_match.split(",")]
+
+def not_modified(etag: str) -> Response:
+    """Empty 304 response"""
+    return Response(status_code=304, headers={"ETag": etag})
+
+def list_cards_statement(list_id: int, limit: int = None, after_card: Card = None):
+    """Select the CardWithoutList columns of a list's cards in order
+
+    Uses the (list_id, list_order) index.  after_card is the last card already seen, for
+    keyset pagination.
+    """
+    statement = select(*CARD_COLUMNS).where(Card.list_id == list_id).order_by(Card.list_order,
+                                                                              Card.card_id)
+    if after_card:
+        if after_card.list_order is None:
+            statement = statement.where(or_(Card.list_order.is_not(None),
+                                            Card.card_id > after_card.card_id))
+        else:
+            statement = statement.where(or_(Card.list_order > after_card.list_order,
+                                            and_(Card.list_order == after_card.list_order,
+                                                 Card.card_id > after_card.card_id)))
+    if limit:
+        statement = statement.limit(limit)
+    return statement
+
+async def stream_list(session: Session | AsyncSession, list_: List, limit: int = None,
+                      after_card: Card = None, ndjson: bool = False):
+    """Yield a list and its cards as JSON (same shape as ListWithCards) or NDJSON
+
+    Cards are read STREAM_CHUNK at a time.  NDJSON is the list without cards on the first
+    line, then one card per line.
+    """
+    header = ListWithCards(**list_.model_dump()).model_dump_json(exclude={"cards"})
+    if ndjson:
+        yield header + "\n"
+    else:
+        yield header[:-1] + ',"cards":['
+    first = True
+    remaining = limit
+    while remaining is None or remaining > 0:
+        chunk = STREAM_CHUNK if remaining is None else min(STREAM_CHUNK, remaining)
+        cards = await read_all(session, list_cards_statement(list_.list_id, chunk, after_card))
+        for card in fastjson.records(CARD_FIELDS, cards):
+            card_json = fastjson.dumps(card)
+            if ndjson:
+                yield card_json + b"\n"
+            elif first:
+                yield card_json
+            else:
+                yield b"," + card_json
+            first = False
+        if len(cards) < chunk:
+            break
+        after_card = cards[-1]
+        if remaining is not None:
+            remaining -= len(cards)
+    if not ndjson:
+        yield "]}"
 
 
 @app.get("/lists/{list_id}", response_model=ListWithCards)
-def get_list(*, session: Session = Depends(get_session), list_id: int):
-    """Get a list of cards by ID"""
-    list_ = session.get(List, list_id)
+async def get_list(*, session: Session | AsyncSession = Depends(get_read_session),
+                   request: Request, list_id: int,
+                   limit: Optional[int] = None, after: Optional[int] = None,
+                   stream: bool = False):
+    """Get a list of cards by ID
+
+    Use limit and after (a card_id) to page through long lists.  Set stream to send cards
+    as they are read; NDJSON is sent instead if the client accepts application/x-ndjson.
+    Send If-None-Match with the last ETag to get a 304 if nothing changed.
+    """
+    list_ = await read_get(session, List, list_id)
     if not list_:
         raise HTTPException(status_code=404)
-    # TODO is there a way to ask SQL to do this for us
-    list_.cards.sort(key=card_list_order)
-    return list_
+    ndjson = stream and "application/x-ndjson" in request.headers.get("accept", "")
+    # NOTE each page and encoding is its own representation, with its own validator
+    variant = "".join([f"-limit-{limit}" if limit else "", f"-after-{after}" if after else "",
+                       "-ndjson" if ndjson else "-stream" if stream else ""])
+    etag = lists_etag([list_], variant)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    after_card = None
+    if after:
+        after_card = await read_get(session, Card, after)
+        if not after_card or after_card.list_id != list_id:
+            raise HTTPException(status_code=400)
+    if stream:
+        return StreamingResponse(stream_list(session, list_, limit, after_card, ndjson),
+                                 media_type="application/x-ndjson" if ndjson
+                                 else "application/json",
+                                 headers={"ETag": etag, "Vary": "Accept"})
+    cards = await read_all(session, list_cards_statement(list_id, limit, after_card))
+    content = {x: getattr(list_, x) for x in ListWithCards.model_fields if x != "cards"}
+    content["cards"] = fastjson.records(CARD_FIELDS, cards)
+    return FastJSONResponse(content, headers={"ETag": etag, "Vary": "Accept"})
+
+async def lists_with_cards(session: Session | AsyncSession,
+                           lists: list[List]) -> list[ListWithCards]:
+    """Attach ordered cards to many lists with a single query"""
+    cards = {x.list_id: [] for x in lists}
+    statement = select(Card).where(Card.list_id.in_(cards)).order_by(Card.list_id,
+                                                                    Card.list_order,
+                                                                    Card.card_id)
+    for card in await read_all(session, statement):
+        cards[card.list_id].append(card)
+    return [ListWithCards(**x.model_dump(), cards=cards[x.list_id]) for x in lists]
 
 @app.post("/lists/{list_id}/cards/", response_model=Card)
 def post_card(*, session: Session = Depends(get_session), list_id: int, card: CardBase):
@@ -179,13 +697,59 @@ def post_card(*, session: Session = Depends(get_session), list_id: int, card: Ca
         raise HTTPException(status_code=404)
     new_card = Card(list_id=list_id, **card.dict())
     if not new_card.list_order:
-        new_card.list_order = generate_list_order(list_.cards)
+        new_card.list_order = generate_list_order(session, list_id)
     new_card.card_open = datetime.date.today()
     session.add(new_card)
+    bump_list_version(session, list_id)
     session.commit()
     session.refresh(new_card)
+    change_feed.publish(ChangeEvent(event="card_created", list_ids=[list_id], card=new_card))
     return new_card
 
+CARD_ARRAY = TypeAdapter(list[CardBase])
+
+async def card_batch(request: Request) -> list[CardBase]:
+    """Cards from a JSON array body, or an NDJSON one (Content-Type application/x-ndjson)"""
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            return [CardBase.model_validate_json(x) for x in body.splitlines() if x.strip()]
+        return CARD_ARRAY.validate_json(body)
+    except ValidationError as exc:
+        raise RequestValidationError(exc.errors()) from exc
+
+@app.post("/lists/{list_id}/cards/bulk", response_model=list[int])
+def post_cards(*, session: Session = Depends(get_session), list_id: int,
+               cards: list[CardBase] = Depends(card_batch)):
+    """Add many cards to the end of a list in one transaction, returning their IDs
+
+    Send the cards as a JSON array or as NDJSON, one card per line
+    """
+    list_ = session.get(List, list_id)
+    if not list_:
+        raise HTTPException(status_code=404)
+    new_orders = iter(free_list_orders(session,
+                                       list_id,
+                                       list_order_neighbour(session, list_id),
+                                       count=len([x for x in cards if not x.list_order])))
+    today = datetime.date.today()
+    new_cards = []
+    for card in cards:
+        new_card = Card(list_id=list_id, **card.dict())
+        if not new_card.list_order:
+            new_card.list_order = next(new_orders)
+        new_card.card_open = today
+        new_cards.append(new_card)
+    session.add_all(new_cards)
+    session.flush()
+    card_ids = [x.card_id for x in new_cards]
+    events = [ChangeEvent(event="card_created", list_ids=[list_id], card=x) for x in new_cards]
+    bump_list_version(session, list_id)
+    session.commit()
+    for event in events:
+        change_feed.publish(event)
+    return card_ids
+
 @app.post("/lists/", response_model=List)
 def post_list(*, session: Session = Depends(get_session), list_: ListBase):
     """Create a list"""
@@ -207,6 +771,9 @@ def post_category(*, session: Session = Depends(get_session), category_: Categor
 def move_card(*, session: Session = Depends(get_session), card_id: int, card_move: CardMove):
     """Move a card, either within a list or to a different list"""
     card = session.get(Card, card_id)
+    if not card:
+        raise HTTPException(status_code=404)
+    old_list_id = card.list_id
     if card_move.list_id:
         # TODO validate category etc
         card.list_id = card_move.list_id
@@ -216,20 +783,17 @@ def move_card(*, session: Session = Depends(get_session), card_id: int, card_mov
         assert not card_move.after_card
         card.list_order = card_move.list_order
     else:
-        assert not (card_move.before_card and card_move.after_card)
-        if card_move.list_id:
-            # NOTE this may be inefficient
-            session.commit()
-            session.refresh(card)
-        all_cards = list(card.list_.cards)
-        if card_move.before_card:
-            card.list_order = generate_list_order(all_cards, before=card_move.before_card)
-        elif card_move.after_card:
-            card.list_order = generate_list_order(all_cards, after=card_move.after_card)
-        else:
-            card.list_order = generate_list_order(all_cards)
+        card.list_order = generate_list_order(session,
+                                              card.list_id,
+                                              before=card_move.before_card,
+                                              after=card_move.after_card,
+                                              exclude=card.card_id)
+    bump_list_version(session, old_list_id, card.list_id)
     session.commit()
     session.refresh(card)
+    change_feed.publish(ChangeEvent(event="card_moved",
+                                    list_ids=[old_list_id, card.list_id],
+                                    card=card))
     return card
 
 @app.post("/cards/{card_id}/close", response_model=Card)
@@ -237,6 +801,7 @@ def close_card(*, session: Session = Depends(get_session), card_id: int, card_cl
     """Complete a task"""
     # TODO duplicate
     card = session.get(Card, card_id)
+    old_list_id = card.list_id
     list_ = None
     if card_close.list_id:
         list_ = session.get(List, card_close.list_id)
@@ -245,13 +810,17 @@ def close_card(*, session: Session = Depends(get_session), card_id: int, card_cl
     else:
         if not card.list_.list_closed:
             # TODO category?
-            statement = select(List).where(List.list_closed)
+            statement = select(List).where(List.list_closed == True)
             list_ = session.exec(statement).one()
             card.list_id = list_.list_id
     card.card_closed = datetime.date.today()
     card.list_order = None
+    bump_list_version(session, old_list_id, card.list_id)
     session.commit()
     session.refresh(card)
+    change_feed.publish(ChangeEvent(event="card_closed",
+                                    list_ids=[old_list_id, card.list_id],
+                                    card=card))
     return card
 
 @app.patch("/cards/{card_id}", response_model=Card)
@@ -263,36 +832,174 @@ def patch_card(*, session: Session = Depends(get_session), card_id: int, card_pa
     card_data = card_patch.model_dump(exclude_unset=True)
     card.sqlmodel_update(card_data)
     #session.add(card)
+    bump_list_version(session, card.list_id)
     session.commit()
     session.refresh(card)
+    change_feed.publish(ChangeEvent(event="card_patched", list_ids=[card.list_id], card=card))
     return card
 
-@app.get("/lists/", response_model=list[List])
-def get_lists(*, session: Session = Depends(get_session)):
-    """Get all lists"""
-    lists = session.exec(select(List)).all()
-    return lists
+def parse_ids(ids: str) -> list[int]:
+    """IDs from a comma separated query parameter, 400 if any is not an integer"""
+    try:
+        return [int(x) for x in ids.split(",")]
+    except ValueError as exc:
+        raise HTTPException(status_code=400,
+                            detail="IDs must be comma separated integers") from exc
+
+@app.get("/lists/", response_model=list[ListWithCards])
+async def get_lists(*, session: Session | AsyncSession = Depends(get_read_session),
+                    request: Request, response: Response, ids: Optional[str] = None,
+                    with_cards: bool = False):
+    """Get all lists, or just a comma separated list of IDs in that order
+
+    Set with_cards to include each list's cards, so a whole board takes one request.
+    Send If-None-Match with the last ETag to get a 304 if nothing changed.
+    """
+    if ids:
+        list_ids = parse_ids(ids)
+        found = {x.list_id: x for x in await read_all(
+            session, select(List).where(List.list_id.in_(list_ids)))}
+        if set(list_ids) - set(found):
+            raise HTTPException(status_code=404)
+        lists = [found[x] for x in list_ids]
+    else:
+        lists = await read_all(session, select(List))
+    etag = lists_etag(lists, "-cards" if with_cards else "")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    if with_cards:
+        return await lists_with_cards(session, lists)
+    return [ListWithCards(**x.model_dump()) for x in lists]
+
+@app.post("/boards/", response_model=Board)
+def post_board(*, session: Session = Depends(get_session), board: BoardBase):
+    """Create a board"""
+    db_board = Board.model_validate(board)
+    session.add(db_board)
+    session.commit()
+    session.refresh(db_board)
+    return db_board
+
+@app.get("/boards/{board_id}", response_model=BoardWithLists)
+async def get_board(*, session: Session | AsyncSession = Depends(get_read_session),
+                    request: Request, response: Response, board_id: int):
+    """Get a board with all its lists (in board_order) and their cards"""
+    board = await read_get(session, Board, board_id)
+    if not board:
+        raise HTTPException(status_code=404)
+    lists = await read_all(session,
+                           select(List).where(List.board_id == board_id).order_by(List.board_order,
+                                                                                  List.list_id))
+    etag = lists_etag(lists, f"-board-{board_id}")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    return BoardWithLists(**board.model_dump(), lists=await lists_with_cards(session, lists))
 
 @app.get("/categories/", response_model=list[Category])
-def get_categories(*, session: Session = Depends(get_session)):
+async def get_categories(*, session: Session | AsyncSession = Depends(get_read_session)):
     """Get all categories"""
-    categories = session.exec(select(Category)).all()
+    categories = await read_all(session, select(Category))
     return categories
 
+def search_terms(text_: str) -> str:
+    """Words in text as an FTS5 query matching every word as a prefix"""
+    return " ".join(f'"{x}"*' for x in re.findall(r"\w+", text_))
+
+@app.get("/cards/search", response_model=list[CardWithoutList])
+async def search_cards(*, session: Session | AsyncSession = Depends(get_read_session),
+                       q: str, include_closed: bool = False, limit: int = 20, offset: int = 0):
+    """Get cards whose name has every word in q (as a prefix), best match first
+
+    Falls back to an unranked LIKE where there is no FTS5 index
+    """
+    statement = select(Card).limit(limit).offset(offset)
+    if not include_closed:
+        statement = statement.where(Card.card_closed == None)
+    if engine.dialect.name != "sqlite":
+        words = re.findall(r"\w+", q)
+        statement = statement.where(*[Card.card_name.like(f"%{x}%") for x in words])
+        return await read_all(session, statement.order_by(Card.card_id.desc()))
+    terms = search_terms(q)
+    if not terms:
+        return []
+    statement = statement.join(card_fts, card_fts.c.rowid == Card.card_id)
+    return await read_all(session, statement.where(card_fts.c.card_fts.op("MATCH")(terms))
+                                            .order_by(card_fts.c.rank))
+
 @app.post("/lists/{list_id}/move", response_model=ListMoveResult)
 def move_list(*, session: Session = Depends(get_session), list_id: int, directions: ListMove):
-    """Perform a bulk operation on a list, often merging all/part with another"""
+    """Perform a bulk operation on a list, often merging all/part with another
+
+    Cards keep their relative order and become one block at the back (or front) of the
+    destination, all in a single UPDATE
+    """
     # TODO implement all CardMove features
-    assert directions.list_id
-    assert not directions.delete
-    assert not directions.category_id
+    if not directions.list_id or directions.list_id == list_id:
+        raise HTTPException(status_code=400)
     start_list = session.get(List, list_id)
     if not start_list:
         raise HTTPException(status_code=404)
     end_list = session.get(List, directions.list_id)
     if not end_list:
         raise HTTPException(status_code=400)  # TODO correct
-    for card in start_list.cards:
-        card.list_id = end_list.list_id
+    selected = [Card.list_id == list_id]
+    if directions.category_id:
+        selected.append(Card.category_id == directions.category_id)
+    moved = session.exec(select(func.count(Card.card_id)).where(*selected)).one()
+    if moved:
+        if directions.front:
+            new_orders = free_list_orders(session, end_list.list_id,
+                                          high=list_order_neighbour(session, end_list.list_id,
+                                                                    below=False),
+                                          count=moved)
+        else:
+            new_orders = free_list_orders(session, end_list.list_id,
+                                          low=list_order_neighbour(session, end_list.list_id),
+                                          count=moved)
+        step = new_orders[1] - new_orders[0] if moved > 1 else 1
+        ranked = select(Card.card_id,
+                        func.row_number().over(order_by=(Card.list_order, Card.card_id))
+                        .label("card_rank")).where(*selected).subquery()
+        session.exec(update(Card)
+                     .where(Card.card_id == ranked.c.card_id)
+                     .values(list_id=end_list.list_id,
+                             list_order=case((Card.list_order.is_(None), None),
+                                             else_=new_orders[0] + step * (ranked.c.card_rank - 1)))
+                     .execution_options(synchronize_session=False))
+    bump_list_version(session, start_list.list_id, end_list.list_id)
+    if directions.delete:
+        if session.exec(select(Card.card_id).where(Card.list_id == list_id).limit(1)).first():
+            session.rollback()
+            raise HTTPException(status_code=409)
+        session.delete(start_list)
     session.commit()
-    return ListMoveResult()  # TODO boring...
+    change_feed.publish(ChangeEvent(event="list_merged",
+                                    list_ids=[list_id, directions.list_id]))
+    return ListMoveResult(moved=moved)
+
+@app.get("/events")
+async def get_events(*, request: Request, list_ids: Optional[str] = None):
+    """Server-sent events for each change to cards and lists, optionally only for some lists
+
+    list_ids is comma separated; each event's data is a ChangeEvent. A client that falls
+    EVENT_BACKLOG events behind gets a resync event and the stream ends.
+    """
+    queue = change_feed.subscribe(set(parse_ids(list_ids)) if list_ids else None)
+
+    async def event_stream():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=EVENT_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event.event}\ndata: {event.model_dump_json()}\n\n"
+                if event.event == "resync":
+                    break
+        finally:
+            change_feed.unsubscribe(queue)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
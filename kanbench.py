@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""Benchmarks for the KanBan API, run in-process against a scratch SQLite DB"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import httpx
+from fastapi.testclient import TestClient
+from sqlalchemy import event, insert, select
+from sqlmodel import Session
+import benchlib
+import fastjson
+import kanapi
+from benchlib import report
+
+# SQLite's own defaults, as kanapi ran before it had settings (minus echo)
+UNTUNED = {"sqlite_journal_mode": None, "sqlite_synchronous": None, "sqlite_busy_timeout": None}
+# Share of the cards in each list of the synthetic board; done is the closed list
+BOARD_LISTS = {"inbox": 0.04, "today": 0.01, "doing": 0.002, "backlog": 0.1, "someday": 0.048,
+               "done": 0.8}
+
+
+def scratch_client(db_file: str, settings: kanapi.Settings = None) -> TestClient:
+    """Return a TestClient for kanapi using a fresh DB file instead of the configured one
+
+    Other settings default to those from KANAPI_* (see kanapi.load_settings)
+    """
+    if not settings:
+        settings = kanapi.settings
+    settings = settings.model_copy(update={"database_url": f"sqlite:///{db_file}"})
+    kanapi.engine, kanapi.async_engine = kanapi.create_engines(settings)
+    kanapi.create_db_and_tables()
+    return TestClient(kanapi.app)
+
+
+def populate(client: TestClient, cards: int) -> tuple[int, int]:
+    """Create a category and a list holding the given number of cards
+
+    Returns the list ID and category ID
+    """
+    category_id = client.post("/categories/", json={"category_name": "bench"}).json()["category_id"]
+    list_id = client.post("/lists/", json={"list_name": "bench"}).json()["list_id"]
+    for start in range(0, cards, 1000):
+        result = client.post(f"/lists/{list_id}/cards/bulk",
+                             json=[{"card_name": f"card {x}", "category_id": category_id}
+                                   for x in range(start, min(start + 1000, cards))])
+        result.raise_for_status()
+    return list_id, category_id
+
+
+def bench_moves(cards: int, moves: int):
+    """Time moving cards into one fixed spot (worst case for gaps) and to random spots"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        client = scratch_client(os.path.join(tmp_dir, "bench.db"))
+        list_id, _ = populate(client, cards)
+        card_ids = [x["card_id"] for x in client.get(f"/lists/{list_id}").json()["cards"]]
+        target = card_ids[len(card_ids) // 2]
+        timings = []
+        for card_id in card_ids[-moves:]:
+            begin = time.perf_counter()
+            client.post(f"/cards/{card_id}/move", json={"before_card": target}).raise_for_status()
+            timings.append(time.perf_counter() - begin)
+        report(f"move same spot {cards} cards", timings)
+        timings = []
+        for card_id in random.sample(card_ids, moves):
+            target = random.choice(card_ids)
+            if target == card_id:
+                continue
+            begin = time.perf_counter()
+            client.post(f"/cards/{card_id}/move", json={"after_card": target}).raise_for_status()
+            timings.append(time.perf_counter() - begin)
+        report(f"move random spot {cards} cards", timings)
+        orders = [x["list_order"] for x in client.get(f"/lists/{list_id}").json()["cards"]]
+        assert len(set(orders)) == len(orders)
+
+
+def bench_merge(cards: int):
+    """Time merging a list of cards into another non-empty list"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        client = scratch_client(os.path.join(tmp_dir, "bench.db"))
+        source_id, _ = populate(client, cards)
+        dest_id, _ = populate(client, cards)
+        begin = time.perf_counter()
+        result = client.post(f"/lists/{source_id}/move", json={"list_id": dest_id})
+        result.raise_for_status()
+        report(f"merge {cards} into {cards} cards", [time.perf_counter() - begin])
+        assert result.json()["moved"] == cards
+
+
+def bench_writes(cards: int, writes: int, variants: dict):
+    """Time sequential post_card calls (one commit each) with different settings"""
+    for name, settings in variants.items():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            client = scratch_client(os.path.join(tmp_dir, "bench.db"), settings)
+            list_id, category_id = populate(client, cards)
+            timings = []
+            for _ in range(writes):
+                begin = time.perf_counter()
+                client.post(f"/lists/{list_id}/cards/",
+                            json={"card_name": "write", "category_id": category_id}
+                            ).raise_for_status()
+                timings.append(time.perf_counter() - begin)
+            report(f"post_card {name} {cards} cards", timings)
+            print(f"{'': <32} {len(timings) / sum(timings):.1f} writes/s")
+
+
+async def drive_load(list_id: int, category_id: int, readers: int, reads: int, writers: int):
+    """Run concurrent readers of a list while writers keep adding cards to it
+
+    Returns read latencies, the wall time for all reads and the number of writes
+    """
+    timings = []
+    writes = []
+    done = asyncio.Event()
+    transport = httpx.ASGITransport(app=kanapi.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://kanbench") as client:
+
+        async def reader():
+            for _ in range(reads):
+                begin = time.perf_counter()
+                (await client.get(f"/lists/{list_id}")).raise_for_status()
+                timings.append(time.perf_counter() - begin)
+
+        async def writer():
+            while not done.is_set():
+                (await client.post(f"/lists/{list_id}/cards/",
+                                   json={"card_name": "load", "category_id": category_id})
+                 ).raise_for_status()
+                writes.append(1)
+
+        write_tasks = [asyncio.create_task(writer()) for _ in range(writers)]
+        begin = time.perf_counter()
+        await asyncio.gather(*[reader() for _ in range(readers)])
+        wall = time.perf_counter() - begin
+        done.set()
+        await asyncio.gather(*write_tasks)
+    return timings, wall, len(writes)
+
+
+def bench_load(cards: int, readers: int, reads: int, writers: int, variants: dict):
+    """Compare get_list under concurrent writes with different settings"""
+    for name, settings in variants.items():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            client = scratch_client(os.path.join(tmp_dir, "bench.db"), settings)
+            list_id, category_id = populate(client, cards)
+            timings, wall, writes = asyncio.run(drive_load(list_id, category_id,
+                                                           readers, reads, writers))
+            report(f"get_list {name} {cards} cards", timings)
+            print(f"{'': <32} {len(timings) / wall:.1f} reads/s and {writes / wall:.1f} writes/s "
+                  f"with {readers} readers, {writers} writers")
+            if kanapi.async_engine:
+                asyncio.run(kanapi.async_engine.dispose())
+
+
+def captured_statements(client: TestClient, method: str, url: str, body: dict = None) -> list:
+    """Call the API and return the (SQL, parameters) it executed"""
+    statements = []
+
+    def capture(_conn, _cursor, statement, parameters, _context, _executemany):
+        statements.append((statement, parameters))
+
+    event.listen(kanapi.engine, "before_cursor_execute", capture)
+    try:
+        client.request(method, url, json=body).raise_for_status()
+    finally:
+        event.remove(kanapi.engine, "before_cursor_execute", capture)
+    return statements
+
+
+def populate_board(cards: int) -> dict:
+    """Insert a board straight into the DB with cards spread over its lists as in BOARD_LISTS
+
+    Returns the board ID, category IDs and list IDs by name
+    """
+    today = datetime.date.today()
+    with Session(kanapi.engine) as session:
+        categories = [kanapi.Category(category_name=x) for x in ("home", "work", "errands")]
+        board = kanapi.Board()
+        session.add_all(categories + [board])
+        session.flush()
+        lists = {x: kanapi.List(list_name=x, board_id=board.board_id, board_order=y,
+                                list_closed=x == "done")
+                 for y, x in enumerate(BOARD_LISTS)}
+        session.add_all(lists.values())
+        session.flush()
+        rows = []
+        for name, share in BOARD_LISTS.items():
+            for order in range(1, int(cards * share) + 1):
+                opened = today - datetime.timedelta(days=random.randint(0, 365))
+                rows.append({"card_name": " ".join(random.sample(benchlib.WORDS, 3)
+                                                   + [str(len(rows))]),
+                             "category_id": random.choice(categories).category_id,
+                             "list_id": lists[name].list_id,
+                             "list_order": None if name == "done" else order * kanapi.RENUMBER_GAP,
+                             "card_open": opened,
+                             "card_closed": opened + datetime.timedelta(days=random.randint(0, 30))
+                                            if name == "done" else None})
+        for start in range(0, len(rows), 10000):
+            session.connection().execute(insert(kanapi.Card), rows[start:start + 10000])
+        board_ids = {"board_id": board.board_id,
+                     "category_ids": [x.category_id for x in categories],
+                     "lists": {x: y.list_id for x, y in lists.items()}}
+        session.commit()
+    return board_ids
+
+
+def bench_rows(cards: int, calls: int):
+    """Time building and encoding a list of cards per card: ORM objects through the Pydantic
+    models as GET /lists/{id} used to, row tuples alone, row tuples with orjson as it does now
+    and the request
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        client = scratch_client(os.path.join(tmp_dir, "bench.db"))
+        list_id, _ = populate(client, cards)
+        client.get(f"/lists/{list_id}").raise_for_status()  # NOTE warm up
+        statement = select(kanapi.Card).where(kanapi.Card.list_id == list_id).order_by(
+            kanapi.Card.list_order, kanapi.Card.card_id)
+
+        def models(_):
+            with Session(kanapi.engine) as session:
+                list_ = session.get(kanapi.List, list_id)
+                cards_ = session.scalars(statement).all()
+                kanapi.ListWithCards(**list_.model_dump(), cards=cards_).model_dump_json()
+
+        def rows_only(_):
+            with Session(kanapi.engine) as session:
+                session.exec(kanapi.list_cards_statement(list_id)).all()
+
+        def rows(_):
+            with Session(kanapi.engine) as session:
+                list_ = session.get(kanapi.List, list_id)
+                cards_ = session.exec(kanapi.list_cards_statement(list_id)).all()
+                content = {x: getattr(list_, x) for x in kanapi.ListWithCards.model_fields
+                           if x != "cards"}
+                content["cards"] = fastjson.records(kanapi.CARD_FIELDS, cards_)
+                fastjson.dumps(content)
+
+        benchlib.per_row("ORM + Pydantic", cards, calls, models)
+        benchlib.per_row("rows only", cards, calls, rows_only)
+        benchlib.per_row("rows + orjson", cards, calls, rows)
+        benchlib.per_row("GET /lists/{id}", cards, calls,
+                         lambda _: client.get(f"/lists/{list_id}").raise_for_status())
+
+
+def bench_suite(cards: int, calls: int, full: int) -> dict:
+    """Time each hot endpoint against a synthetic board of this many cards
+
+    Endpoints returning a whole list are called full times, the rest calls times.
+    Returns a summary per endpoint.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        client = scratch_client(os.path.join(tmp_dir, "bench.db"))
+        board = populate_board(cards)
+        lists = board["lists"]
+        with Session(kanapi.engine) as session:
+            card_ids = {x: list(session.scalars(select(kanapi.Card.card_id)
+                                                .where(kanapi.Card.list_id == lists[x])))
+                        for x in ("inbox", "today", "backlog", "someday")}
+        moving = random.sample(card_ids["inbox"], min(calls, len(card_ids["inbox"])))
+        closing = random.sample(card_ids["someday"], min(calls, len(card_ids["someday"])))
+
+        def call(method, url, body=None):
+            client.request(method, url, json=body).raise_for_status()
+
+        call("GET", f"/lists/{lists['today']}")  # NOTE warm up, the first request is slow
+
+        def move(_):
+            card_id, target = random.sample(card_ids["backlog"], 2)
+            call("POST", f"/cards/{card_id}/move", {"before_card": target})
+
+        results = {
+            "get_list": benchlib.timed(
+                f"get_list {len(card_ids['today'])} of {cards}", full,
+                lambda _: call("GET", f"/lists/{lists['today']}")),
+            "get_list_page": benchlib.timed(
+                f"get_list 50 of {cards}", calls,
+                lambda _: call("GET", f"/lists/{lists['backlog']}?limit=50")),
+            "get_lists": benchlib.timed(f"get_lists {cards}", calls,
+                                        lambda _: call("GET", "/lists/")),
+            "search_cards": benchlib.timed(
+                f"search_cards {cards}", calls,
+                lambda _: call("GET", f"/cards/search?q={random.choice(benchlib.WORDS)}")),
+            "post_card": benchlib.timed(
+                f"post_card {cards}", calls,
+                lambda _: call("POST", f"/lists/{lists['inbox']}/cards/",
+                               {"card_name": "bench", "category_id": board["category_ids"][0]})),
+            "move_card": benchlib.timed(f"move_card {cards}", calls, move),
+            "move_card_list": benchlib.timed(
+                f"move_card to list {cards}", len(moving),
+                lambda x: call("POST", f"/cards/{moving[x]}/move", {"list_id": lists["today"]})),
+            "close_card": benchlib.timed(
+                f"close_card {cards}", len(closing),
+                lambda x: call("POST", f"/cards/{closing[x]}/close", {}))}
+    return results
+
+
+def check_query_plans(cards: int) -> bool:
+    """EXPLAIN the SQL behind the hot endpoints and report any full table scans
+
+    Returns True if every query is served by an index
+    """
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        client = scratch_client(os.path.join(tmp_dir, "bench.db"))
+        list_id, category_id = populate(client, cards)
+        other_list_id, _ = populate(client, cards)
+        closed_id = client.post("/lists/", json={"list_name": "done",
+                                                 "list_closed": True}).json()["list_id"]
+        card_ids = [x["card_id"] for x in client.get(f"/lists/{list_id}").json()["cards"]]
+        hot_calls = [("get_list", "GET", f"/lists/{list_id}?limit=50", None),
+                     ("get_list after", "GET", f"/lists/{list_id}?limit=50&after={card_ids[9]}",
+                      None),
+                     ("get_lists", "GET", f"/lists/?ids={list_id},{closed_id}&with_cards=true",
+                      None),
+                     ("post_card", "POST", f"/lists/{list_id}/cards/",
+                      {"card_name": "explain", "category_id": category_id}),
+                     ("move_card", "POST", f"/cards/{card_ids[1]}/move",
+                      {"before_card": card_ids[-1]}),
+                     ("close_card", "POST", f"/cards/{card_ids[1]}/close", {}),
+                     ("move_list", "POST", f"/lists/{list_id}/move",
+                      {"list_id": other_list_id, "category_id": category_id, "front": True})]
+        for name, method, url, body in hot_calls:
+            statements = captured_statements(client, method, url, body)
+            with kanapi.engine.connect() as connection:
+                for statement, parameters in statements:
+                    if not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                        continue
+                    plan = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement,
+                                                      parameters).all()
+                    scans = [x[3] for x in plan if re.match(r"SCAN (TABLE )?(card|list)\b", x[3])]
+                    if scans:
+                        ok = False
+                        print(f"{name}: {' '.join(statement.split())}")
+                        for scan in scans:
+                            print(f"    {scan}")
+    print("all hot queries use indexes" if ok else "table scans found")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--moves", type=int, default=200)
+    parser.add_argument("-l", "--load", action="store_true",
+                        help="load test sync vs async reads during writes instead of timing moves")
+    parser.add_argument("-t", "--tuning", action="store_true",
+                        help="load test SQLite defaults vs tuned settings instead of timing moves")
+    parser.add_argument("-g", "--merge", action="store_true",
+                        help="time merging lists instead of timing moves")
+    parser.add_argument("-e", "--explain", action="store_true",
+                        help="check the hot queries use indexes instead of timing moves")
+    parser.add_argument("-s", "--suite", action="store_true",
+                        help="time each hot endpoint on a synthetic board instead of timing moves")
+    parser.add_argument("-p", "--per-row", action="store_true",
+                        help="time serializing a list per card instead of timing moves")
+    parser.add_argument("-c", "--calls", type=int, default=200,
+                        help="calls per endpoint in the suite")
+    parser.add_argument("-f", "--full", type=int, default=20,
+                        help="calls per endpoint returning a whole list in the suite")
+    parser.add_argument("-o", "--output", help="save suite results to this JSON file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-r", "--readers", type=int, default=20)
+    parser.add_argument("-w", "--writers", type=int, default=4)
+    parser.add_argument("sizes", nargs="*", type=int, default=[1000, 10000, 50000])
+    cargs = parser.parse_args()
+    random.seed(cargs.seed)
+    if cargs.suite:
+        suite_results = {str(x): bench_suite(x, cargs.calls, cargs.full) for x in cargs.sizes}
+        if cargs.output:
+            benchlib.save(cargs.output, "kanapi", suite_results,
+                          calls=cargs.calls, full=cargs.full, seed=cargs.seed)
+        sys.exit()
+    if cargs.explain:
+        sys.exit(0 if all(check_query_plans(x) for x in cargs.sizes) else 1)
+    for size in cargs.sizes:
+        if cargs.load:
+            bench_load(size, cargs.readers, 10, cargs.writers,
+                       {"sync": kanapi.Settings(), "async": kanapi.Settings(async_reads=True)})
+        elif cargs.merge:
+            bench_merge(size)
+        elif cargs.per_row:
+            bench_rows(size, cargs.full)
+        elif cargs.tuning:
+            tunings = {"untuned": kanapi.Settings(**UNTUNED), "tuned": kanapi.Settings()}
+            bench_writes(size, cargs.moves, tunings)
+            bench_load(size, cargs.readers, 10, cargs.writers, tunings)
+        else:
+            bench_moves(size, cargs.moves)
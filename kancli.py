@@ -2,26 +2,101 @@
 """Client for KanBan API"""
 
 import os
+import csv
 import datetime
 from typing import Annotated
 import sys
 import requests
 import typer
+import kanlocal
 
 KANAPI_URL = os.environ.get('KANAPI_URL', 'http://127.0.0.1:29325/')
+BULK_CHUNK = 500
+# NOTE queue writes in the replica without trying the API
+OFFLINE = bool(os.environ.get('KANCLI_OFFLINE'))
 
 app = typer.Typer()
 
 
+def post_cards(list_id: int, cards: list[dict]):
+    """Add many cards to a list via the bulk API, BULK_CHUNK at a time; yields new IDs"""
+    for start in range(0, len(cards), BULK_CHUNK):
+        result = requests.post(f"{KANAPI_URL}lists/{list_id}/cards/bulk",
+                               json=cards[start:start + BULK_CHUNK],
+                               timeout=30)
+        result.raise_for_status()
+        yield from result.json()
+
+
+def open_replica() -> kanlocal.Replica | None:
+    """The local replica, if kancli sync has created one"""
+    if not kanlocal.Replica.exists():
+        return None
+    return kanlocal.Replica(KANAPI_URL)
+
+
+def add_cards(list_id: int, cards: list[dict]):
+    """Add cards to a list, or queue them in the replica if offline; prints the card IDs
+
+    Queued cards get temporary negative IDs until kancli sync
+    """
+    local = open_replica()
+    done = 0
+    if not (local and (OFFLINE or local.pending())):
+        try:
+            for card_id in post_cards(list_id, cards):
+                print(card_id)
+                done += 1
+            if local:
+                local.pull([list_id])
+            return
+        except kanlocal.OFFLINE_ERRORS:
+            if not local:
+                raise
+    for card in cards[done:]:
+        print(local.queue_add(list_id, card))
+
+
+def send(local: kanlocal.Replica | None, call, card_id: int) -> bool:
+    """Make a write to a card with call() and refresh the lists it touched in the replica
+
+    Returns False if the write should be queued in the replica instead
+    """
+    if local and (OFFLINE or local.pending()):
+        return False
+    old = local.card(card_id) if local else None
+    try:
+        card = call()
+    except kanlocal.OFFLINE_ERRORS:
+        if not local:
+            raise
+        return False
+    if local:
+        local.pull(sorted({card['list_id'], old['list_id'] if old else card['list_id']}))
+    return True
+
+
 @app.command("list")
-def list_(list_id: int, category_id: int = None, tabbed: bool = False, csv_: bool = False):
-    """List all cards in a given list"""
-    # TODO allow filter via category
-    # TODO 'tabbed' output
-    # TODO csv output... allow offline completion/moving?
-    result = requests.get(f"{KANAPI_URL}lists/{list_id}", timeout=1)
-    result.raise_for_status()
-    for card in result.json()['cards']:
+def list_(list_id: int, category_id: int = None, tabbed: bool = False,
+          csv_: Annotated[bool, typer.Option("--csv")] = False):
+    """List all cards in a given list, from the replica if there is one
+
+    --tabbed and --csv print the card ID, category ID and name of each
+    """
+    local = open_replica()
+    if local:
+        cards = local.cards(list_id, category_id)
+    else:
+        result = requests.get(f"{KANAPI_URL}lists/{list_id}", timeout=1)
+        result.raise_for_status()
+        cards = [x for x in result.json()['cards']
+                 if not category_id or x['category_id'] == category_id]
+    if tabbed or csv_:
+        writer = csv.writer(sys.stdout, delimiter='\t' if tabbed else ',')
+        writer.writerow(['card_id', 'category_id', 'card_name'])
+        writer.writerows([x['card_id'], x['category_id'], x['card_name']] for x in cards)
+        return
+    for card in cards:
         print(card['card_name'])
 
 @app.command()
@@ -33,22 +108,85 @@ def add(list_id: Annotated[int, typer.Option()],
         cards = [' '.join(card)]
     else:
         cards = [x.strip() for x in sys.stdin]
-    for mycard in cards:
-        result = requests.post(f"{KANAPI_URL}lists/{list_id}/cards/",
-                               json={'card_name': mycard,
-                                     'category_id': category_id},
-                               timeout=2)
-        result.raise_for_status()
-        print(result.json()['card_id'])
+    add_cards(list_id, [{'card_name': x, 'category_id': category_id} for x in cards])
 
 @app.command("import")
-def import_(list_id: int, file_name: str, category_id: int = None, t: bool = False):
+def import_(list_id: int, file_name: str, category_id: Annotated[int, typer.Option()],
+            t: bool = False):
     """Import list from a file"""
-    # TODO implement (match CSV output of list_()?)
+    # TODO match CSV output of list_()?
     # TODO figure out what "t" is (tabbed from list_()?)
     # TODO make usage kancli import -l LIST_ID [-c CONTEXT_ID] [-t] FILE_NAME
     # TODO handle offline completion, moving, etc
-    assert False
+    with open(file_name, encoding='utf-8') as import_file:
+        cards = [{'card_name': x.strip(), 'category_id': category_id}
+                 for x in import_file if x.strip()]
+    add_cards(list_id, cards)
+
+@app.command()
+def close(card_id: int, list_id: int = None):
+    """Close a card, moving it to list_id or the closed list; queued if offline"""
+    local = open_replica()
+
+    def call():
+        result = requests.post(f"{KANAPI_URL}cards/{card_id}/close",
+                               json={'list_id': list_id},
+                               timeout=2)
+        result.raise_for_status()
+        return result.json()
+
+    if not send(local, call, card_id):
+        local.queue_close(card_id, list_id)
+        print('queued')
+
+@app.command()
+def move(card_id: int, list_id: int = None, before: int = None, after: int = None):
+    """Move a card before or after another, or to the end of a list; queued if offline
+
+    Cards added offline have negative IDs until synced, give them after -- (move -- -1)
+    """
+    assert not (before and after)
+    local = open_replica()
+    card_move = {'list_id': list_id, 'before_card': before, 'after_card': after}
+
+    def call():
+        result = requests.post(f"{KANAPI_URL}cards/{card_id}/move", json=card_move, timeout=2)
+        result.raise_for_status()
+        return result.json()
+
+    if not send(local, call, card_id):
+        local.queue_move(card_id, card_move)
+        print('queued')
+
+@app.command()
+def sync(force: bool = False):
+    """Replay queued writes, then fetch lists changed since the last sync into the replica
+
+    Creates the replica (KANCLI_REPLICA, default ~/.kancli.db) the first time.  Writes that
+    conflict with changes on the server are kept; see kancli queue, or retry with --force.
+    """
+    local = kanlocal.Replica(KANAPI_URL)
+    try:
+        applied, failed = local.replay(force)
+        pulled = local.pull()
+    except kanlocal.OFFLINE_ERRORS:
+        print(f"API unreachable, {local.pending()} writes still queued")
+        raise typer.Exit(1)
+    print(f"{applied} writes applied, {failed} not, {pulled} lists refreshed")
+    if failed:
+        raise typer.Exit(1)
+
+@app.command()
+def queue(drop: int = None, clear: bool = False):
+    """Show writes waiting for kancli sync, or drop one (or --clear all) of them"""
+    local = open_replica()
+    assert local, "no replica, see kancli sync"
+    if drop or clear:
+        local.drop(drop)
+        return
+    for item in local.queued():
+        print(item['op_id'], item['op'], item['card_id'], item['list_id'], item['body'],
+              item['status'], item['error'] or '')
 
 @app.command()
 def new_category(category_name: str):
@@ -63,42 +201,86 @@ def new_category(category_name: str):
 def new_list(list_name: str,
              category_id: int = None,
              closed: bool = False,
-             wakeup: datetime.datetime = None):
+             wakeup: datetime.datetime = None,
+             board_id: int = None,
+             board_order: int = None):
     """create a new list"""
     result = requests.post(f"{KANAPI_URL}lists/",
                            json={'list_name': list_name,
                                  'list_closed': closed,
                                  'category_id': category_id,
+                                 'board_id': board_id,
+                                 'board_order': board_order,
                                  'list_wakeup': wakeup.date().isoformat() if wakeup else None},
                            timeout=2)
     result.raise_for_status()
     print(result.json()['list_id'])
 
+@app.command()
+def new_board(user: str = None, category_id: int = None):
+    """Create a new board; add lists to it with new-list --board-id"""
+    result = requests.post(f"{KANAPI_URL}boards/",
+                           json={'user': user,
+                                 'category_id': category_id},
+                           timeout=2)
+    result.raise_for_status()
+    print(result.json()['board_id'])
+
 @app.command()
 def lists():
     """Return all lists with their IDs"""
-    result = requests.get(f"{KANAPI_URL}lists/",
-                           timeout=1)
-    result.raise_for_status()
-    for item in result.json():
+    local = open_replica()
+    if local:
+        items = local.lists()
+    else:
+        result = requests.get(f"{KANAPI_URL}lists/",
+                              timeout=1)
+        result.raise_for_status()
+        items = result.json()
+    for item in items:
         print(item['list_id'], item['list_name'], item['list_wakeup'])
 
 @app.command()
 def categories():
     """Return all categories with their IDs"""
-    result = requests.get(f"{KANAPI_URL}categories/",
-                           timeout=1)
-    result.raise_for_status()
-    for item in result.json():
+    local = open_replica()
+    if local:
+        items = local.categories()
+    else:
+        result = requests.get(f"{KANAPI_URL}categories/",
+                              timeout=1)
+        result.raise_for_status()
+        items = result.json()
+    for item in items:
         print(item['category_id'], item['category_name'])
 
 @app.command()
-def merge(source_list: int, dest_list: int):
-    """Merge one list into another"""
+def search(words: list[str], include_closed: bool = False, limit: int = 20):
+    """Find cards whose name has all the words, best match first"""
+    result = requests.get(f"{KANAPI_URL}cards/search",
+                          params={'q': ' '.join(words),
+                                  'include_closed': include_closed,
+                                  'limit': limit},
+                          timeout=1)
+    result.raise_for_status()
+    for card in result.json():
+        print(card['card_id'], card['list_id'], card['card_name'])
+
+@app.command()
+def merge(source_list: int,
+          dest_list: int,
+          category_id: int = None,
+          front: bool = False,
+          delete: bool = False):
+    """Merge one list (or its cards in a category) into the back or front of another"""
     result = requests.post(f"{KANAPI_URL}lists/{source_list}/move",
-                           json={'list_id': dest_list},
+                           json={'list_id': dest_list,
+                                 'category_id': category_id,
+                                 'front': front,
+                                 'delete': delete},
                            timeout=5)
     result.raise_for_status()
+    print(result.json()['moved'])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,367 @@
+"""Local SQLite replica of the KanBan API, with a queue of writes made while offline"""
+
+import datetime
+import json
+import os
+import sqlite3
+import requests
+
+REPLICA_FILE = os.path.expanduser(os.environ.get('KANCLI_REPLICA', '~/.kancli.db'))
+OFFLINE_ERRORS = (requests.ConnectionError, requests.Timeout)
+IDS_CHUNK = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS list (list_id INTEGER PRIMARY KEY, list_version INTEGER, data TEXT);
+CREATE TABLE IF NOT EXISTS card (card_id INTEGER PRIMARY KEY, list_id INTEGER, list_order REAL,
+                                 category_id INTEGER, card_closed TEXT, data TEXT);
+CREATE INDEX IF NOT EXISTS ix_card_list_id_list_order ON card (list_id, list_order, card_id);
+CREATE TABLE IF NOT EXISTS category (category_id INTEGER PRIMARY KEY, data TEXT);
+CREATE TABLE IF NOT EXISTS queue (op_id INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT, card_id INTEGER,
+                                  list_id INTEGER, body TEXT, base TEXT,
+                                  status TEXT DEFAULT 'pending', error TEXT);
+"""
+# NOTE list_version -1 marks a list changed locally, so the next pull refetches it
+STALE = -1
+
+
+class Replica:
+    """Copy of the lists, cards and categories of one API, kept current with pull()
+
+    Writes made while offline are applied here straight away, with negative
+    card IDs for new cards, and queued to be replayed against the API by replay().
+    """
+
+    def __init__(self, url: str, file_name: str = REPLICA_FILE):
+        self.url = url
+        self.db = sqlite3.connect(file_name)
+        self.db.executescript(SCHEMA)
+        stored = self.meta('url')
+        assert stored in (None, url), f"{file_name} is a replica of {stored}"
+        self.set_meta('url', url)
+        self.db.commit()
+        self.session = requests.Session()
+
+    @staticmethod
+    def exists(file_name: str = REPLICA_FILE) -> bool:
+        """Whether a replica has been created"""
+        return os.path.exists(file_name)
+
+    def close(self):
+        """Close the DB and connections"""
+        self.db.close()
+        self.session.close()
+
+    def meta(self, key: str) -> str | None:
+        """Read a setting"""
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        """Save a setting (caller commits)"""
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    # Reads
+
+    def lists(self) -> list[dict]:
+        """All lists, without cards"""
+        return [json.loads(x) for x, in self.db.execute("SELECT data FROM list ORDER BY list_id")]
+
+    def categories(self) -> list[dict]:
+        """All categories"""
+        return [json.loads(x) for x, in self.db.execute("SELECT data FROM category "
+                                                        "ORDER BY category_id")]
+
+    def cards(self, list_id: int, category_id: int = None) -> list[dict]:
+        """Cards of a list in order, optionally only one category"""
+        statement = "SELECT data FROM card WHERE list_id = ?"
+        params = [list_id]
+        if category_id:
+            statement += " AND category_id = ?"
+            params.append(category_id)
+        statement += " ORDER BY list_order, card_id"
+        return [json.loads(x) for x, in self.db.execute(statement, params)]
+
+    def card(self, card_id: int) -> dict | None:
+        """One card"""
+        row = self.db.execute("SELECT data FROM card WHERE card_id = ?", (card_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # Sync from the API
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """GET from the API, raising for errors"""
+        result = self.session.get(f"{self.url}{url}", timeout=5, **kwargs)
+        result.raise_for_status()
+        return result
+
+    def fetch_lists(self, list_ids: list[int]) -> list[dict]:
+        """Lists with their cards from the API, IDS_CHUNK at a time"""
+        lists = []
+        for start in range(0, len(list_ids), IDS_CHUNK):
+            ids = ",".join(str(x) for x in list_ids[start:start + IDS_CHUNK])
+            lists += self.get("lists/", params={'ids': ids, 'with_cards': True}).json()
+        return lists
+
+    def pull(self, list_ids: list[int] = None) -> int:
+        """Refetch the lists (and their cards) whose version changed, or just list_ids
+
+        Returns how many lists were refetched
+        """
+        gone = []
+        result = None
+        if list_ids is None:
+            etag = self.meta('lists_etag')
+            result = self.get("lists/", headers={'If-None-Match': etag} if etag else None)
+            categories = self.get("categories/").json()
+            with self.db:
+                self.db.execute("DELETE FROM category")
+                self.db.executemany("INSERT INTO category (category_id, data) VALUES (?, ?)",
+                                    [(x['category_id'], json.dumps(x)) for x in categories])
+            if result.status_code == 304:
+                return 0
+            server = {x['list_id']: x['list_version'] for x in result.json()}
+            local = dict(self.db.execute("SELECT list_id, list_version FROM list"))
+            list_ids = [x for x, y in server.items() if local.get(x) != y]
+            gone = [(x,) for x in set(local) - set(server)]
+        lists = self.fetch_lists(list_ids)
+        with self.db:
+            self.db.executemany("DELETE FROM list WHERE list_id = ?", gone)
+            self.db.executemany("DELETE FROM card WHERE list_id = ?", gone)
+            for list_ in lists:
+                cards = list_.pop('cards')
+                self.db.execute("INSERT OR REPLACE INTO list (list_id, list_version, data) "
+                                "VALUES (?, ?, ?)",
+                                (list_['list_id'], list_['list_version'], json.dumps(list_)))
+                self.db.execute("DELETE FROM card WHERE list_id = ?", (list_['list_id'],))
+                self.db.executemany("INSERT OR REPLACE INTO card VALUES (?, ?, ?, ?, ?, ?)",
+                                    [(x['card_id'], x['list_id'], x['list_order'],
+                                      x['category_id'], x['card_closed'], json.dumps(x))
+                                     for x in cards])
+            if result is not None and not self.pending():
+                # NOTE only trust the ETag once no local changes are waiting to be replayed
+                self.set_meta('lists_etag', result.headers.get('ETag'))
+        return len(lists)
+
+    # Offline writes
+
+    def pending(self) -> int:
+        """How many writes are waiting to be replayed, not counting conflicts and failures"""
+        return self.db.execute("SELECT count(*) FROM queue WHERE status = 'pending'").fetchone()[0]
+
+    def queued(self) -> list[dict]:
+        """Writes waiting to be replayed, oldest first"""
+        self.db.row_factory = sqlite3.Row
+        try:
+            return [dict(x) for x in self.db.execute("SELECT * FROM queue ORDER BY op_id")]
+        finally:
+            self.db.row_factory = None
+
+    def drop(self, op_id: int = None):
+        """Forget a queued write, or all of them; the next pull undoes them locally"""
+        with self.db:
+            if op_id:
+                self.db.execute("DELETE FROM queue WHERE op_id = ?", (op_id,))
+            else:
+                self.db.execute("DELETE FROM queue")
+
+    def base(self, card_id: int) -> str | None:
+        """The server's state of a card, to detect conflicts when replaying its first write
+
+        None for new cards and cards with writes already queued, as those build on our own
+        """
+        if card_id < 0 or self.db.execute("SELECT 1 FROM queue WHERE card_id = ?",
+                                           (card_id,)).fetchone():
+            return None
+        card = self.card(card_id)
+        assert card, f"card {card_id} is not in the replica"
+        return json.dumps({x: card[x] for x in ('list_id', 'list_order', 'card_closed')})
+
+    def enqueue(self, op: str, card_id: int, list_id: int, body: dict, base: str = None) -> int:
+        """Add a write to the queue (caller commits), returning its ID"""
+        return self.db.execute("INSERT INTO queue (op, card_id, list_id, body, base) "
+                               "VALUES (?, ?, ?, ?, ?)",
+                               (op, card_id, list_id, json.dumps(body), base)).lastrowid
+
+    def save_card(self, card: dict, *list_ids: int):
+        """Write a locally changed card and mark its lists stale (caller commits)"""
+        self.db.execute("INSERT OR REPLACE INTO card VALUES (?, ?, ?, ?, ?, ?)",
+                        (card['card_id'], card['list_id'], card['list_order'],
+                         card['category_id'], card['card_closed'], json.dumps(card)))
+        self.db.executemany("UPDATE list SET list_version = ? WHERE list_id = ?",
+                            [(STALE, x) for x in list_ids])
+        self.db.execute("DELETE FROM meta WHERE key = 'lists_etag'")
+
+    def end_order(self, list_id: int) -> float:
+        """A list_order after every card in a list"""
+        last = self.db.execute("SELECT max(list_order) FROM card WHERE list_id = ?",
+                               (list_id,)).fetchone()[0]
+        return (last or 0) + 1
+
+    def queue_add(self, list_id: int, card: dict) -> int:
+        """Add a card locally and queue it; returns its temporary (negative) ID"""
+        assert self.db.execute("SELECT 1 FROM list WHERE list_id = ?", (list_id,)).fetchone()
+        with self.db:
+            op_id = self.enqueue('add', None, list_id, card)
+            self.db.execute("UPDATE queue SET card_id = ? WHERE op_id = ?", (-op_id, op_id))
+            self.save_card({'card_name': card['card_name'], 'card_due': None,
+                            'category_id': card['category_id'],
+                            'list_order': self.end_order(list_id),
+                            'card_open': datetime.date.today().isoformat(), 'card_closed': None,
+                            'card_duplicate': False, 'card_pom_tgt': None,
+                            'card_id': -op_id, 'list_id': list_id}, list_id)
+        return -op_id
+
+    def queue_move(self, card_id: int, move: dict):
+        """Move a card locally and queue it, move as for the API's CardMove"""
+        base = self.base(card_id)
+        card = self.card(card_id)
+        assert card
+        old_list_id = card['list_id']
+        card['list_id'] = move.get('list_id') or old_list_id
+        if move.get('list_order'):
+            card['list_order'] = move['list_order']
+        elif move.get('before_card') or move.get('after_card'):
+            before = bool(move.get('before_card'))
+            other = self.card(move['before_card'] if before else move['after_card'])
+            assert other and other['list_id'] == card['list_id']
+            neighbour = self.db.execute(
+                "SELECT {}(list_order) FROM card WHERE list_id = ? AND list_order {} ? "
+                "AND card_id != ?".format('max' if before else 'min', '<' if before else '>'),
+                (card['list_id'], other['list_order'], card_id)).fetchone()[0]
+            if neighbour is None:
+                neighbour = other['list_order'] + (-1 if before else 1)
+            card['list_order'] = (neighbour + other['list_order']) / 2
+        else:
+            card['list_order'] = self.end_order(card['list_id'])
+        with self.db:
+            self.enqueue('move', card_id, card['list_id'], move, base)
+            self.save_card(card, old_list_id, card['list_id'])
+
+    def queue_close(self, card_id: int, list_id: int = None):
+        """Close a card locally and queue it, moving it to list_id or the closed list"""
+        base = self.base(card_id)
+        card = self.card(card_id)
+        assert card and not card['card_closed']
+        old_list_id = card['list_id']
+        if list_id or not json.loads(self.db.execute("SELECT data FROM list WHERE list_id = ?",
+                                                     (old_list_id,)).fetchone()[0])['list_closed']:
+            closed = [x['list_id'] for x in self.lists() if x['list_closed']]
+            assert list_id in closed if list_id else len(closed) == 1
+            card['list_id'] = list_id or closed[0]
+        card['card_closed'] = datetime.date.today().isoformat()
+        card['list_order'] = None
+        with self.db:
+            self.enqueue('close', card_id, card['list_id'], {'list_id': list_id}, base)
+            self.save_card(card, old_list_id, card['list_id'])
+
+    # Replay
+
+    def conflict(self, op: dict, server: dict) -> str | None:
+        """Why a queued write no longer applies to the card on the server, if it does not"""
+        if not op['base']:
+            return None
+        base = json.loads(op['base'])
+        card = server.get(op['card_id'])
+        if not card:
+            return f"card left list {base['list_id']}"
+        if card['card_closed'] != base['card_closed']:
+            return f"card closed {card['card_closed']} on the server"
+        if card['list_order'] != base['list_order']:
+            return f"card list_order changed from {base['list_order']} to {card['list_order']}"
+        return None
+
+    def finish(self, op: dict, status: str = None, error: str = None):
+        """Remove a replayed write from the queue, or record why it was not"""
+        with self.db:
+            if status:
+                self.db.execute("UPDATE queue SET status = ?, error = ? WHERE op_id = ?",
+                                (status, error, op['op_id']))
+            else:
+                self.db.execute("DELETE FROM queue WHERE op_id = ?", (op['op_id'],))
+
+    def post(self, url: str, body) -> requests.Response:
+        """POST to the API, raising for errors"""
+        result = self.session.post(f"{self.url}{url}", json=body, timeout=10)
+        result.raise_for_status()
+        return result
+
+    def resolve_ids(self, new_ids: dict[int, int]):
+        """Point queued writes at the real IDs of cards the API has added (caller commits)
+
+        new_ids maps temporary (negative) IDs to real ones
+        """
+        self.db.executemany("UPDATE queue SET card_id = ? WHERE card_id = ?",
+                            [(y, x) for x, y in new_ids.items()])
+        for op_id, body in self.db.execute("SELECT op_id, body FROM queue").fetchall():
+            body = json.loads(body)
+            changed = {x: new_ids[body[x]] for x in ('before_card', 'after_card')
+                       if body.get(x) in new_ids}
+            if changed:
+                self.db.execute("UPDATE queue SET body = ? WHERE op_id = ?",
+                                (json.dumps(body | changed), op_id))
+
+    def replay(self, force: bool = False) -> tuple[int, int]:
+        """Send queued writes to the API in order, returning how many applied and did not
+
+        New cards in a list are added in one bulk call.  Moves and closes are checked
+        against the card's list, list_order and closed state on the server when queued;
+        if another client changed any of those the write is marked a conflict and kept
+        (with any later writes to the card).  Conflicts and writes the API refused are
+        only retried, without checks, if force is set.
+        """
+        ops = [x for x in self.queued() if force or x['status'] == 'pending']
+        base_lists = {json.loads(x['base'])['list_id'] for x in ops if x['base']}
+        existing = {x['list_id'] for x in self.get("lists/").json()}
+        server = {y['card_id']: y for x in self.fetch_lists(sorted(base_lists & existing))
+                  for y in x['cards']}
+        new_ids = {}
+        blocked = set()
+        applied = failed = 0
+        while ops:
+            op = ops.pop(0)
+            if op['op'] == 'add':
+                adds = [op]
+                while ops and ops[0]['op'] == 'add' and ops[0]['list_id'] == op['list_id']:
+                    adds.append(ops.pop(0))
+                try:
+                    card_ids = self.post(f"lists/{op['list_id']}/cards/bulk",
+                                         [json.loads(x['body']) for x in adds]).json()
+                except requests.HTTPError as err:
+                    for add in adds:
+                        self.finish(add, 'failed', str(err))
+                        blocked.add(add['card_id'])
+                    failed += len(adds)
+                    continue
+                added = {x['card_id']: y for x, y in zip(adds, card_ids)}
+                new_ids.update(added)
+                with self.db:
+                    self.db.executemany("DELETE FROM queue WHERE op_id = ?",
+                                        [(x['op_id'],) for x in adds])
+                    self.resolve_ids(added)
+                applied += len(adds)
+                continue
+            body = json.loads(op['body'])
+            for key in ('before_card', 'after_card'):
+                if body.get(key):
+                    body[key] = new_ids.get(body[key], body[key])
+            card_id = new_ids.get(op['card_id'], op['card_id'])
+            reason = None if force else self.conflict(op, server)
+            if op['card_id'] in blocked or card_id < 0 or (body.get('before_card') or 0) < 0 \
+                    or (body.get('after_card') or 0) < 0:
+                reason = "an earlier write to this card was not applied"
+            if reason:
+                self.finish(op, 'conflict', reason)
+                blocked.add(op['card_id'])
+                failed += 1
+                continue
+            try:
+                self.post(f"cards/{card_id}/{op['op']}", body)
+            except requests.HTTPError as err:
+                self.finish(op, 'failed', str(err))
+                blocked.add(op['card_id'])
+                failed += 1
+                continue
+            self.finish(op)
+            applied += 1
+        return applied, failed
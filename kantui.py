@@ -3,11 +3,14 @@
 
 import os
 import argparse
+import json
 from typing import Any
+from textual import work
 from textual.app import App, ComposeResult
 from textual.widgets import Footer, Header, Button, Input, Label
 from textual.containers import HorizontalScroll, VerticalScroll
 from textual.screen import ModalScreen
+from textual.worker import get_current_worker
 import requests
 
 KANAPI_URL = os.environ.get('KANAPI_URL', 'http://127.0.0.1:29325/')
@@ -50,23 +53,25 @@ class KanCard(Button):
         self.card_json = result.json()
         self.label = self.card_json['card_name']
 
+    def sort_key(self) -> tuple:
+        """Position in a list, same as the API's ordering (no list_order first)"""
+        list_order = self.card_json['list_order']
+        return (list_order is not None, list_order or 0, self.card_id)
 
 
 
 class KanList(VerticalScroll):
     """A vertically scrolling kanban column of cards"""
 
-    def __init__(self, *args: Any, list_url: str, **kwargs: Any):
-        self.kba_url = list_url
-        self.list_id = None
+    def __init__(self, *args: Any, list_json: dict, **kwargs: Any):
+        self.list_json = list_json
+        self.list_id = list_json['list_id']
+        self.kba_url = f"{KANAPI_URL}lists/{self.list_id}"
         super().__init__(*args, **kwargs)
 
     def compose(self) -> ComposeResult:
-        result = requests.get(self.kba_url, timeout=1).json()
-        self.list_id = result['list_id']
-        cards = result['cards']
-        yield Label(result['list_name'])
-        for card in cards:
+        yield Label(self.list_json['list_name'])
+        for card in self.list_json['cards']:
             yield KanCard(card_json=card)
 
     def add_card(self, card_name, category_id):
@@ -77,6 +82,20 @@ class KanList(VerticalScroll):
                                timeout=2)
         self.mount(KanCard(card_json=result.json()))
 
+    def place_card(self, card: KanCard) -> None:
+        """Put a card (new or already in this list) where its list_order says"""
+        following = [x for x in self.child_cards()
+                     if x is not card and x.sort_key() > card.sort_key()]
+        if card.parent is self:
+            if following:
+                self.move_child(card, before=following[0])
+            elif len(self.child_cards()) > 1:
+                self.move_child(card, after=self.children[-1])
+        elif following:
+            self.mount(card, before=following[0])
+        else:
+            self.mount(card)
+
     def child_cards(self):
         """Return child cards (omit label)"""
         return self.children[1:]
@@ -107,21 +126,89 @@ class KanBanApp(App):
 
     selected_move_card = None
     kan_list_ids = []
+    kan_board_id = None
     kan_category_id = None
 
-    def __init__(self, *args: Any, lists: list[int] = None, category: int = None, **kwargs: Any):
+    def __init__(self, *args: Any, lists: list[int] = None, board: int = None,
+                 category: int = None, **kwargs: Any):
         self.kan_list_ids = lists
+        self.kan_board_id = board
         self.kan_category_id = category
         super().__init__(*args, **kwargs)
 
+    def fetch_lists(self) -> list[dict]:
+        """Get all lists to show along with their cards in one request"""
+        if self.kan_board_id:
+            result = requests.get(f"{KANAPI_URL}boards/{self.kan_board_id}", timeout=3)
+            result.raise_for_status()
+            return result.json()['lists']
+        result = requests.get(f"{KANAPI_URL}lists/",
+                              params={'ids': ','.join(str(x) for x in self.kan_list_ids),
+                                      'with_cards': True},
+                              timeout=3)
+        result.raise_for_status()
+        return result.json()
+
     def compose(self) -> ComposeResult:
         """Create child widgets for the app."""
         yield Header()
         yield Footer()
-        lizts = [KanList(list_url=f"{KANAPI_URL}/lists/{x}") for x in self.kan_list_ids]
+        lizts = [KanList(list_json=x) for x in self.fetch_lists()]
         yield HorizontalScroll(*lizts)
         # TODO focus on a card
 
+    def on_mount(self) -> None:
+        """Start following changes made by others"""
+        self.follow_events()
+
+    @work(thread=True, exclusive=True)
+    def follow_events(self) -> None:
+        """Apply change events from the API to the board, reconnecting as needed"""
+        worker = get_current_worker()
+        list_ids = ','.join(str(x.list_id) for x in self.query(KanList))
+        while not worker.is_cancelled:
+            try:
+                with requests.get(f"{KANAPI_URL}events",
+                                  params={'list_ids': list_ids},
+                                  stream=True,
+                                  timeout=(3, 60)) as result:
+                    for line in result.iter_lines(decode_unicode=True):
+                        if worker.is_cancelled:
+                            return
+                        if line and line.startswith('data:'):
+                            self.call_from_thread(self.apply_event, json.loads(line[5:]))
+            except requests.RequestException:
+                if worker.is_cancelled:
+                    return
+
+    def apply_event(self, event: dict) -> None:
+        """Update just the affected cards for a change event"""
+        if event['event'] in ('list_merged', 'resync'):
+            # resync: the API dropped events for us, so reload everything
+            self.selected_move_card = None
+            self.refresh(recompose=True)
+            return
+        self.apply_card(event['card'])
+
+    def apply_card(self, card_json: dict) -> None:
+        """Show the latest version of a card in the right list and position, if shown"""
+        if self.selected_move_card and self.selected_move_card.card_id == card_json['card_id']:
+            # The user is busy moving it; their move wins
+            return
+        card = next((x for x in self.query(KanCard) if x.card_id == card_json['card_id']), None)
+        tgt_list = next((x for x in self.query(KanList)
+                         if x.list_id == card_json['list_id']), None)
+        if card and card.parent is not tgt_list:
+            card.remove()
+            card = None
+        if not tgt_list:
+            return
+        if not card:
+            card = KanCard(card_json=card_json)
+        card.card_json = card_json
+        card.label = card_json['card_name']
+        tgt_list.place_card(card)
+
     #def action_toggle_dark(self) -> None:
     #    """An action to toggle dark mode."""
     #    self.theme = (
@@ -282,16 +369,19 @@ class KanBanApp(App):
                             json={},
                             timeout=3)
         res.raise_for_status()
-        # TODO can we avoid all-out-refresh?
         self.selected_move_card = None
-        self.refresh(recompose=True)
+        self.apply_card(res.json())
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--category")
-    parser.add_argument("lists", nargs="+")
+    parser.add_argument("-b", "--board", help="show lists of a server side board")
+    parser.add_argument("lists", nargs="*")
     cargs = parser.parse_args()
+    if not (cargs.board or cargs.lists):
+        parser.error("specify lists or a board")
     app = KanBanApp(lists=[int(x) for x in cargs.lists],
+                    board=(int(cargs.board) if cargs.board else None),
                     category=(int(cargs.category) if cargs.category else None))
     app.run()
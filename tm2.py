@@ -22,14 +22,14 @@ def dateornull(dateobj=None, abbrev=False):
 
 def taskstr(tsk):
     """String representation of a task"""
-    exp = tsk.export()
-    return '{: <8} {: <4} {} {: >2} {} {} {}'.format(exp['mode'].upper(),
-                                                     exp['context'].upper() if exp['context'] else '',
+    context = tsk['context']
+    return '{: <8} {: <4} {} {: >2} {} {} {}'.format(tsk['mode'].upper(),
+                                                     context.upper() if context else '',
                                                      tsk.uif(),
-                                                     str(exp['pomodoros']),
+                                                     str(tsk['pomodoros']),
                                                      dateornull(tsk.getsched(), abbrev=True),
                                                      dateornull(tsk.get_due(), abbrev=True),
-                                                     exp['name'])
+                                                     tsk['name'])
 
 def taskchoice(objlist, new_opt=False, api_obj=None, new_def=None):
     """Given a list of task objects, show them and let a user pick one - return the object
@@ -78,8 +78,7 @@ def triageone(tobj):
     choice = inquirer.confirm("Continue?", default=True)
     if not choice:
         return
-    for tsk in tobj:
-        tupdate(tsk, answers, confirm=False)
+    tobj[0].api.update_many(tobj, answers)
 
 def scheduleone(tobj):
     """Schedule one object"""
@@ -117,18 +116,18 @@ def scheduleone(tobj):
     if not isinstance(newsched, datetime.datetime):
         newsched = datetime.datetime.combine(newsched,
                                              datetime.time.fromisoformat(inquirer.text(message='time')))
-    for tsk in tobj:
-        if tsk.getsched() != newsched:
-            # TODO confirm
-            tsk.schedule(newsched)
+    # TODO confirm
+    changed = [tsk for tsk in tobj if tsk.getsched() != newsched]
+    if changed:
+        tobj[0].api.update_many(changed, {'wakeup': newsched.isoformat()})
     choice = inquirer.confirm("Do you want to assign/reset a due date?", default=True)
     if not choice:
         return
     newdue = datetime.date.fromisoformat(inquirer.text(message='date'))
     newdue = datetime.datetime.combine(newdue, datetime.time(hour=0))
-    for tsk in tobj:
-        if tsk.get_due() != newdue:
-            tsk.set_due(newdue)
+    changed = [tsk for tsk in tobj if tsk.get_due() != newdue]
+    if changed:
+        tobj[0].api.update_many(changed, {'due': newdue.isoformat()})
 
 
 
@@ -166,14 +165,12 @@ def taskact(mychoice, default=None):
                     base = tsk.export()['warm']
                 elif base != tsk.export()['warm']:
                     print('Can only stage or unstage, not both')
-            for tsk in mychoice:
-                tsk.warm(un=base)
+            mychoice[0].api.update_many(mychoice, {'warm': not base})
             default = 'exit'
         elif action == 'execute':
             if inquirer.confirm('Close this task?'):
-                for tsk in mychoice:
-                    # TODO duplicate, etc
-                    tsk.close()
+                # TODO duplicate, etc
+                mychoice[0].api.close_many(mychoice)
                 return
         elif action == 'exit':
             return
@@ -312,17 +309,19 @@ def paper(ctx, until, mode, context):
         utl = datetime.datetime.fromisoformat(until)
     if utl:
         assert mode in ('paper', 'stage')
-    tasklist = ctx.obj['API'].all_tasks(mode=mode, until=utl, context=context)
+    tasklist = ctx.obj['API'].task_collection(mode=mode, until=utl, context=context)
     for tsk in tasklist:
         print(taskstr(tsk))
 
 @cli.command()
 @click.pass_context
+@click.option('-n', '--limit', default=50, show_default=True,
+              help='Show at most this many of the best matches')
 @click.argument('task', nargs=-1, required=True)
-def search(ctx, task):
+def search(ctx, task, limit):
     """Search for a task and allow wakeup or creation (aka upsert)"""
     srch_str = " ".join(task)
-    tasklist = ctx.obj['API'].search_tasks(task_search=srch_str)
+    tasklist = ctx.obj['API'].search_tasks(task_search=srch_str, limit=limit)
     mychoice = taskchoice(tasklist, new_opt=True, api_obj=ctx.obj['API'], new_def=srch_str)
     taskact(mychoice, 'schedule')
 
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""Benchmarks for the TaskMaster v2 API and client, run against a scratch SQLite DB"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import requests
+import werkzeug.serving
+import benchlib
+import fastjson
+from benchlib import WORDS, report
+
+
+def delayed(app, latency: float):
+    """Wrap a WSGI app to sleep latency seconds per request, emulating a network round trip"""
+
+    def wrapper(environ, start_response):
+        time.sleep(latency)
+        return app(environ, start_response)
+
+    return wrapper
+
+
+def scratch_api(tmp_dir: str):
+    """Import tmsqlapi configured to use a fresh DB file, return the module"""
+    cfg = os.path.join(tmp_dir, "tmbench.cfg")
+    with open(cfg, "w", encoding="utf-8") as cfg_file:
+        cfg_file.write(f"SQLALCHEMY_DATABASE_URI = 'sqlite:///{tmp_dir}/tmbench.db'\n")
+    os.environ["TMSQLAPI_SETTINGS"] = cfg
+    import tmsqlapi  # pylint: disable=import-outside-toplevel
+    return tmsqlapi
+
+
+def scratch_server(tmp_dir: str, latency: float = 0) -> werkzeug.serving.BaseWSGIServer:
+    """Start tmsqlapi on a free local port using a fresh DB file
+
+    The server runs in a daemon thread; call shutdown() when done.
+    """
+    tmsqlapi = scratch_api(tmp_dir)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = werkzeug.serving.make_server("127.0.0.1", 0,
+                                          delayed(tmsqlapi.app, latency) if latency
+                                          else tmsqlapi.app,
+                                          threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_calls(url: str, calls: int):
+    """Time one small GET per call with a new connection each vs a pooled TMApi
+
+    Then with the TMApi cache revalidating (304) and trusting (TTL) its copy
+    """
+    import tmclilib  # pylint: disable=import-outside-toplevel
+    client = tmclilib.TMApi(url, cache_bytes=0)
+    tid = client.new_task({"name": "bench"}).tid
+    timings = []
+    for _ in range(calls):
+        begin = time.perf_counter()
+        result = requests.get(f"{url}tasks/{tid}", timeout=tmclilib.TIMEOUT)
+        result.raise_for_status()
+        result.json()
+        timings.append(time.perf_counter() - begin)
+    report("get task, connection per call", timings)
+    timings = []
+    for _ in range(calls):
+        begin = time.perf_counter()
+        client.one_task(tid)
+        timings.append(time.perf_counter() - begin)
+    report("get task, pooled TMApi", timings)
+    client.close()
+    for name, ttls in (("revalidated", None), ("cached", {"tasks/": 60})):
+        client = tmclilib.TMApi(url, cache_ttls=ttls)
+        client.one_task(tid)
+        timings = []
+        for _ in range(calls):
+            begin = time.perf_counter()
+            client.one_task(tid)
+            timings.append(time.perf_counter() - begin)
+        report(f"get task, {name} TMApi", timings)
+        print(f"{'': <32} {dict(client.cache.stats)}")
+        client.close()
+
+
+async def fan_out(url: str, batch: list, changes: dict):
+    """Update the tasks with concurrent single-task calls"""
+    import tmclilib  # pylint: disable=import-outside-toplevel
+    async with tmclilib.AsyncTMApi(url) as async_api:
+        await async_api.update_many(batch, changes)
+
+
+def bench_bulk(url: str, tasks: int):
+    """Time rescheduling a batch of tasks serially, with AsyncTMApi fan-out and in one batch call"""
+    import tmclilib  # pylint: disable=import-outside-toplevel
+    client = tmclilib.TMApi(url)
+    batch = [client.new_task({"name": f"bulk {x}"}) for x in range(tasks)]
+    wakeup = datetime.datetime.now() + datetime.timedelta(days=1)
+    begin = time.perf_counter()
+    for tsk in batch:
+        tsk.schedule(wakeup)
+    report(f"schedule {tasks} tasks serially", [time.perf_counter() - begin])
+    wakeup += datetime.timedelta(days=1)
+    begin = time.perf_counter()
+    asyncio.run(fan_out(url, batch, {"wakeup": wakeup.isoformat()}))
+    report(f"schedule {tasks} tasks fan-out", [time.perf_counter() - begin])
+    assert all(tsk.getsched() == wakeup for tsk in batch)
+    wakeup += datetime.timedelta(days=1)
+    begin = time.perf_counter()
+    client.update_many(batch, {"wakeup": wakeup.isoformat()})
+    report(f"schedule {tasks} tasks batch", [time.perf_counter() - begin])
+    assert all(tsk.getsched() == wakeup for tsk in batch)
+    begin = time.perf_counter()
+    client.close_many(batch)
+    report(f"close {tasks} tasks batch", [time.perf_counter() - begin])
+    assert all(tsk.export()["closed"] for tsk in batch)
+    client.close()
+
+
+def populate(tmsqlapi, tasks: int):
+    """Insert a random mix of tasks in every mode straight into the DB"""
+    now = datetime.datetime.now()
+
+    def when(days):
+        return now + datetime.timedelta(days=random.uniform(-days, days))
+
+    def ago(days):
+        return now - datetime.timedelta(days=random.uniform(0, days))
+
+    def slot(days):
+        """One of the common times people schedule for, 6am or noon on a day"""
+        return datetime.datetime.combine(datetime.date.today(),
+                                         datetime.time(hour=random.choice([6, 12]))
+                                         ) + datetime.timedelta(days=random.randint(-days, days))
+
+    rows = [{"name": " ".join(random.sample(WORDS, 3) + [str(x)]),
+             "priority": random.choice([None, 0, 8, 16, 24]),
+             "urgent": random.choice([None, True, False]),
+             "important": random.choice([None, True, False]),
+             "frog": random.random() < 0.05,
+             "pomodoros": random.choice([None, 1, 2, 4]),
+             "wakeup": random.choice([None, slot(30)]),
+             "warm": random.random() < 0.1,
+             "created": ago(365),
+             "closed": ago(365) if random.random() < 0.7 else None,
+             "context": random.choice([None] + tmsqlapi.CTX),
+             "due": when(60) if random.random() < 0.1 else None}
+            for x in range(tasks)]
+    for row in rows:
+        if row["due"] and row["wakeup"] and row["wakeup"] >= row["due"]:
+            row["due"] = None
+    with tmsqlapi.app.app_context():
+        tmsqlapi.db.session.execute(tmsqlapi.db.insert(tmsqlapi.Task), rows)
+        tmsqlapi.db.session.commit()
+
+
+def bench_modes(tasks: int, reads: int):
+    """Time GET /tasks/ for each mode in-process over a large table"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmsqlapi = scratch_api(tmp_dir)
+        populate(tmsqlapi, tasks)
+        client = tmsqlapi.app.test_client()
+        for query in ["mode=open", "mode=closed", "mode=execute", "mode=stage",
+                      "mode=stage&context=hmdy", "mode=paper", "mode=paper&context=hmdy",
+                      "mode=schedule", "mode=triage"]:
+            timings = []
+            for _ in range(reads):
+                begin = time.perf_counter()
+                result = client.get(f"/tasks/?{query}")
+                assert result.status_code == 200
+                timings.append(time.perf_counter() - begin)
+            report(f"{query} {len(result.json)}", timings)
+        for query in ["", "context=hmdy", "type=due"]:
+            timings = []
+            for _ in range(reads):
+                begin = time.perf_counter()
+                result = client.get(f"/timelines/?{query}")
+                assert result.status_code == 200
+                timings.append(time.perf_counter() - begin)
+            report(f"timelines {query} {len(result.json)}", timings)
+        with tmsqlapi.app.app_context():
+            timings = []
+            for _ in range(reads):
+                begin = time.perf_counter()
+                tmsqlapi.db.session.execute(tmsqlapi.db.select(
+                    tmsqlapi.Task.wakeup, tmsqlapi.db.func.count(tmsqlapi.Task.wakeup)).where(
+                        tmsqlapi.Task.closed == None,
+                        tmsqlapi.Task.wakeup >= datetime.datetime.now()).group_by(
+                            tmsqlapi.Task.wakeup)).all()
+                timings.append(time.perf_counter() - begin)
+            report("timelines by GROUP BY on task", timings)
+            timings = []
+            for _ in range(reads):
+                begin = time.perf_counter()
+                tmsqlapi.db.session.execute(tmsqlapi.db.select(
+                    tmsqlapi.Timeline.at, tmsqlapi.db.func.sum(tmsqlapi.Timeline.count)).where(
+                        tmsqlapi.Timeline.kind == "wakeup",
+                        tmsqlapi.Timeline.at >= datetime.datetime.now()).group_by(
+                            tmsqlapi.Timeline.at)).all()
+                timings.append(time.perf_counter() - begin)
+            report("timelines from aggregate", timings)
+
+
+def bench_search(tasks: int, reads: int):
+    """Time ranked full text search against the LIKE scan it replaced, in-process"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmsqlapi = scratch_api(tmp_dir)
+        populate(tmsqlapi, tasks)
+        client = tmsqlapi.app.test_client()
+        for words in ["garage", "fix car", "invoi", "12345"]:
+            timings = []
+            for _ in range(reads):
+                begin = time.perf_counter()
+                result = client.get("/tasks/", query_string={"search": words, "mode": "all",
+                                                              "limit": 50})
+                assert result.status_code == 200
+                timings.append(time.perf_counter() - begin)
+            report(f"search {words!r} top 50", timings)
+            with tmsqlapi.app.app_context():
+                timings = []
+                for _ in range(reads):
+                    begin = time.perf_counter()
+                    tmsqlapi.db.session.execute(tmsqlapi.db.select(tmsqlapi.Task.id).where(
+                        *[tmsqlapi.Task.name.like(f"%{x}%") for x in words.split()])).all()
+                    timings.append(time.perf_counter() - begin)
+                report(f"LIKE {words!r} ids only", timings)
+        begin = time.perf_counter()
+        result = client.get("/tasks/1/similar")
+        report("similar to task 1", [time.perf_counter() - begin])
+
+
+def bench_changes(tasks: int, reads: int, changed: int = 20):
+    """Time a full sync against a delta sync after a few updates, in-process"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmsqlapi = scratch_api(tmp_dir)
+        populate(tmsqlapi, tasks)
+        client = tmsqlapi.app.test_client()
+        begin = time.perf_counter()
+        result = client.get("/tasks/changes")
+        report(f"full sync {tasks} tasks", [time.perf_counter() - begin])
+        cursor = result.json["cursor"]
+        for tid in random.sample(range(1, tasks + 1), changed):
+            assert client.put(f"/tasks/{tid}", json={"name": "changed"}).status_code == 200
+        timings = []
+        for _ in range(reads):
+            begin = time.perf_counter()
+            result = client.get("/tasks/changes", query_string={"since": cursor})
+            timings.append(time.perf_counter() - begin)
+        report(f"delta sync {changed} changed", timings)
+        assert len(result.json["tasks"]) == changed
+
+
+def bench_rows(tasks: int, reads: int):
+    """Time building and encoding every task per task: ORM objects through mode_one() and
+    marshalling, rows alone, rows with marshalling as GET /tasks/ used to, rows with orjson
+    as it does now and the request
+    """
+    import flask_restx  # pylint: disable=import-outside-toplevel
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmsqlapi = scratch_api(tmp_dir)
+        populate(tmsqlapi, tasks)
+        client = tmsqlapi.app.test_client()
+        with tmsqlapi.app.app_context():
+            query = tmsqlapi.mode_where(order_by=[tmsqlapi.Task.id])
+
+            def models(_):
+                mytasks = tmsqlapi.Task.query.order_by(tmsqlapi.Task.id).all()
+                json.dumps(flask_restx.marshal(tmsqlapi.mode_many(mytasks), tmsqlapi.task))
+                tmsqlapi.db.session.expunge_all()
+
+            benchlib.per_row("ORM + mode_one + marshal", tasks, reads, models)
+            benchlib.per_row("rows only", tasks, reads, lambda _: tmsqlapi.mode_rows(query))
+            benchlib.per_row("rows + marshal", tasks, reads, lambda _: json.dumps(
+                flask_restx.marshal(tmsqlapi.mode_rows(query), tmsqlapi.task)))
+            benchlib.per_row("rows + orjson", tasks, reads,
+                             lambda _: fastjson.dumps(tmsqlapi.mode_rows(query)))
+        benchlib.per_row("GET /tasks/?mode=all", tasks, reads,
+                         lambda _: client.get("/tasks/?mode=all"))
+
+
+def bench_paper(tasks: int, reads: int):
+    """Time fetching and rendering a paper report of about tasks open tasks, as dicts in
+    Tasks from all_tasks() vs columns in a TaskCollection, and the memory each holds
+    """
+    import tracemalloc  # pylint: disable=import-outside-toplevel
+    import tmclilib  # pylint: disable=import-outside-toplevel
+    import tm2  # pylint: disable=import-outside-toplevel
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        server = scratch_server(tmp_dir)
+        tmsqlapi = sys.modules["tmsqlapi"]
+        populate(tmsqlapi, tasks)
+        with tmsqlapi.app.app_context():
+            tmsqlapi.db.session.execute(tmsqlapi.db.update(tmsqlapi.Task).values(closed=None))
+            tmsqlapi.db.session.commit()
+        api = tmclilib.TMApi(f"http://127.0.0.1:{server.server_port}/", cache_bytes=0)
+        for name, fetch in [("all_tasks", api.all_tasks), ("task_collection", api.task_collection)]:
+            fetches, renders = [], []
+            for _ in range(reads):
+                begin = time.perf_counter()
+                mytasks = fetch(mode="paper")
+                fetched = time.perf_counter()
+                for tsk in mytasks:
+                    tm2.taskstr(tsk)
+                fetches.append(fetched - begin)
+                renders.append(time.perf_counter() - fetched)
+                del mytasks
+            report(f"{name} fetch {tasks}", fetches)
+            report(f"{name} render", renders)
+            tracemalloc.start()
+            mytasks = fetch(mode="paper")
+            for tsk in mytasks:
+                tm2.taskstr(tsk)
+            # NOTE the server's allocations are freed by now, the peak includes them
+            print(f"{name} held {tracemalloc.get_traced_memory()[0] / 2**20:.1f}MB "
+                  f"for {len(mytasks)} tasks")
+            tracemalloc.stop()
+            del mytasks
+        server.shutdown()
+
+
+SUITE_MODES = ["open", "execute", "stage", "paper", "schedule", "triage"]
+
+
+def bench_suite(sizes: list[int], calls: int, full: int) -> dict:
+    """Time TaskList.get for each mode and the other hot endpoints in-process
+
+    One table is grown through the sizes, as tmsqlapi binds its DB on import.  Lists of
+    every task in a mode are fetched full times, other endpoints called calls times.
+    Returns a summary per endpoint for each size.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmsqlapi = scratch_api(tmp_dir)
+        client = tmsqlapi.app.test_client()
+
+        def call(method, url, body=None):
+            result = client.open(url, method=method, json=body)
+            assert result.status_code == 200, result.status
+            return result
+
+        tasks = 0
+        for size in sorted(sizes):
+            if size > tasks:
+                populate(tmsqlapi, size - tasks)
+                tasks = size
+            with tmsqlapi.app.app_context():
+                ids = list(tmsqlapi.db.session.scalars(tmsqlapi.db.select(tmsqlapi.Task.id)))
+                open_ids = list(tmsqlapi.db.session.scalars(tmsqlapi.db.select(
+                    tmsqlapi.Task.id).where(tmsqlapi.Task.closed == None)))
+                since = tmsqlapi.db.session.scalar(tmsqlapi.db.select(
+                    tmsqlapi.db.func.max(tmsqlapi.Task.seq)))
+            closing = random.sample(open_ids, min(calls, len(open_ids)))
+            call("GET", "/tasks/?mode=paper")  # NOTE warm up, the first request is slow
+            results[str(size)] = endpoints = {}
+            for mode in SUITE_MODES:
+                endpoints[f"tasks mode={mode}"] = benchlib.timed(
+                    f"mode={mode} {size}", full,
+                    lambda _, mode=mode: call("GET", f"/tasks/?mode={mode}"))
+            for mode in ["all", "closed"]:
+                endpoints[f"tasks mode={mode} page"] = benchlib.timed(
+                    f"mode={mode} 500 of {size}", calls,
+                    lambda _, mode=mode: call("GET", f"/tasks/?mode={mode}&limit=500"))
+            endpoints["search"] = benchlib.timed(
+                f"search {size}", calls,
+                lambda _: call("GET", f"/tasks/?mode=all&limit=50&search={random.choice(WORDS)}"))
+            endpoints["timelines"] = benchlib.timed(f"timelines {size}", calls,
+                                                    lambda _: call("GET", "/timelines/"))
+            endpoints["get_task"] = benchlib.timed(
+                f"get task {size}", calls, lambda _: call("GET", f"/tasks/{random.choice(ids)}"))
+            endpoints["put_task"] = benchlib.timed(
+                f"put task {size}", calls,
+                lambda _: call("PUT", f"/tasks/{random.choice(ids)}", {"name": "bench"}))
+            endpoints["close_task"] = benchlib.timed(
+                f"close task {size}", len(closing),
+                lambda x: call("POST", f"/tasks/{closing[x]}/action", {"close": True}))
+            endpoints["changes"] = benchlib.timed(
+                f"changes after writes {size}", calls,
+                lambda _: call("GET", f"/tasks/changes?since={since}"))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--calls", type=int, default=500)
+    parser.add_argument("-b", "--bulk", type=int, default=200,
+                        help="number of tasks to update in the bulk benchmark")
+    parser.add_argument("-m", "--modes", type=int,
+                        help="time listing each mode over this many tasks instead")
+    parser.add_argument("-s", "--search", type=int,
+                        help="time searching this many tasks instead")
+    parser.add_argument("-y", "--sync", type=int,
+                        help="time full vs delta sync of this many tasks instead")
+    parser.add_argument("-p", "--per-row", type=int,
+                        help="time serializing this many tasks per task instead")
+    parser.add_argument("--paper", type=int,
+                        help="time a paper report of this many open tasks in the client instead")
+    parser.add_argument("--suite", type=int, nargs="*",
+                        help="time each hot endpoint over tables of these sizes instead")
+    parser.add_argument("-f", "--full", type=int, default=5,
+                        help="fetches of each whole mode in the suite")
+    parser.add_argument("-o", "--output", help="save suite results to this JSON file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-r", "--reads", type=int, default=5)
+    parser.add_argument("-l", "--latency", type=float, default=0,
+                        help="milliseconds added to each request to emulate a network")
+    cargs = parser.parse_args()
+    random.seed(cargs.seed)
+    if cargs.suite is not None:
+        suite_results = bench_suite(cargs.suite or [1000, 10000, 100000], cargs.calls, cargs.full)
+        if cargs.output:
+            benchlib.save(cargs.output, "tmsqlapi", suite_results,
+                          calls=cargs.calls, full=cargs.full, seed=cargs.seed)
+        sys.exit()
+    if cargs.modes:
+        bench_modes(cargs.modes, cargs.reads)
+        sys.exit()
+    if cargs.search:
+        bench_search(cargs.search, cargs.reads)
+        sys.exit()
+    if cargs.sync:
+        bench_changes(cargs.sync, cargs.reads)
+        sys.exit()
+    if cargs.per_row:
+        bench_rows(cargs.per_row, cargs.reads)
+        sys.exit()
+    if cargs.paper:
+        bench_paper(cargs.paper, cargs.reads)
+        sys.exit()
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        bench_server = scratch_server(scratch_dir, cargs.latency / 1000)
+        bench_url = f"http://127.0.0.1:{bench_server.server_port}/"
+        bench_calls(bench_url, cargs.calls)
+        bench_bulk(bench_url, cargs.bulk)
+        bench_server.shutdown()
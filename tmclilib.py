@@ -1,7 +1,36 @@
 """Task Master Client Library"""
 
+import array
+import asyncio
+import collections
 import datetime
+import json
+import sys
+import threading
+import time
+import httpx
 import requests
+import requests.adapters
+import urllib3.util
+
+# Seconds to wait for a connection and for a response
+TIMEOUT = (3.05, 30)
+# Default memory bound for cached responses, and seconds they are trusted before revalidating
+CACHE_BYTES = 4 * 2**20
+CACHE_TTLS = {'contexts/': 120, 'timelines/': 60}
+# Fields of a task as the API sends them, in the order of its task model
+TASK_FIELDS = ('id', 'name', 'created', 'closed', 'updated', 'urgent', 'important', 'frog',
+               'wakeup', 'warm', 'pomodoros', 'priority', 'mode', 'context', 'due')
+FIELD_INDEX = {x: i for i, x in enumerate(TASK_FIELDS)}
+DATE_FIELDS = ('created', 'closed', 'updated', 'wakeup', 'due')
+# Fields with few distinct values, which TaskCollection shares rather than keep a copy per task
+INTERNED_FIELDS = ('mode', 'context')
+# How TaskCollection.sort() orders modes, as in paper mode
+MODE_ORDER = {x: i for i, x in enumerate(['overdue', 'warm', 'awake', 'asleep', 'schedule',
+                                          'triage', 'closed'])}
+UNPARSED = object()
+# Lines of an NDJSON stream decoded at once
+STREAM_BATCH = 500
 
 
 def priority_letter(priority: int) -> str:
@@ -15,16 +44,57 @@ def priority_letter(priority: int) -> str:
     return letter
 
 
+def parse_datetime(value):
+    """datetime from an ISO string from the API, or None"""
+    if not value:
+        return None
+    return datetime.datetime.fromisoformat(value)
+
+
 class Task:
-    """Single task object that exists in DB"""
+    """Single task object that exists in DB
+
+    Fields are kept as a tuple in TASK_FIELDS order, read them with task['name'].
+    Dates are parsed the first time they are asked for.
+    """
     # TODO allow this to be used for new, arbitrary updates, etc
     # TODO check for conflicts
     # TODO triage
+    __slots__ = ('api', 'tid', 'values', 'wakeup_at', 'due_at')
 
     def __init__(self, api, dct):
         self.api = api
         self.dct = dct
-        self.tid = dct['id']
+
+    @classmethod
+    def from_values(cls, api, values, wakeup_at=UNPARSED, due_at=UNPARSED):
+        """Task from a tuple of fields in TASK_FIELDS order, and its dates if parsed"""
+        tsk = cls.__new__(cls)
+        tsk.api = api
+        tsk.values = values
+        tsk.tid = values[0]
+        tsk.wakeup_at = wakeup_at
+        tsk.due_at = due_at
+        return tsk
+
+    def set_values(self, values):
+        """Replace all fields with a tuple in TASK_FIELDS order"""
+        self.values = values
+        self.tid = values[0]
+        self.wakeup_at = UNPARSED
+        self.due_at = UNPARSED
+
+    @property
+    def dct(self):
+        """Dictionary of the fields, as the API sent them"""
+        return dict(zip(TASK_FIELDS, self.values))
+
+    @dct.setter
+    def dct(self, dct):
+        self.set_values(tuple([dct.get(x) for x in TASK_FIELDS]))
+
+    def __getitem__(self, field):
+        return self.values[FIELD_INDEX[field]]
 
     def export(self):
         """Dictionary representation"""
@@ -56,10 +126,9 @@ class Task:
 
     def getsched(self):
         """Get datetime object corresponding to wakeup"""
-        # TODO this should just be native
-        if not self.dct['wakeup']:
-            return None
-        return datetime.datetime.fromisoformat(self.dct['wakeup'])
+        if self.wakeup_at is UNPARSED:
+            self.wakeup_at = parse_datetime(self['wakeup'])
+        return self.wakeup_at
 
     def set_due(self, when):
         """Set a due date"""
@@ -67,21 +136,22 @@ class Task:
 
     def get_due(self):
         """Get due date"""
-        if not self.dct['due']:
-            return None
-        return datetime.datetime.fromisoformat(self.dct['due'])
+        if self.due_at is UNPARSED:
+            self.due_at = parse_datetime(self['due'])
+        return self.due_at
 
     def __repr__(self):
         return 'Task({}, {}, {}, {})'.format(self.tid,
                                              self.api.url,
-                                             self.dct['mode'],
-                                             self.dct['name'])
+                                             self['mode'],
+                                             self['name'])
 
     def uif(self):
         """Return an Urgent/Important/Frog string"""
         outstr = ''
         for item in ['urgent', 'important', 'frog']:
-            if self.dct.get(item):
+            # NOTE straight from values, as paper mode calls this for every task
+            if self.values[FIELD_INDEX[item]]:
                 outstr += item[0].upper()
             else:
                 outstr += ' '
@@ -98,7 +168,7 @@ class Task:
         # TODO support for letter and absolute
         assert letter is None
         assert absolute is None
-        old = self.export()['priority']
+        old = self['priority']
         if old is None:
             # default is 0
             old = 0
@@ -145,30 +215,305 @@ class Task:
         return new - old, priority_letter(new), new
 
 
+class TaskCollection:
+    """Many tasks kept as columns, a list per field, rather than an object per task
+
+    filter() and sort() return views that share the columns and only hold an array of
+    row numbers.  Dates are parsed a column at a time, once, when first needed.
+    Iterating makes a Task per row as it goes.
+    """
+
+    def __init__(self, api, rows=()):
+        """Collect tasks from an iterable of API dictionaries"""
+        self.api = api
+        self.columns = {x: [] for x in TASK_FIELDS}
+        self.dates = {}
+        self.order = None  # NOTE all rows, as added
+        self.extend(rows)
+
+    def extend(self, rows):
+        """Add tasks from an iterable of API dictionaries"""
+        assert self.order is None, 'extend the whole collection, not a view'
+        start = len(self.columns['id'])
+        for row in rows:
+            for field, column in self.columns.items():
+                column.append(row.get(field))
+        for field in INTERNED_FIELDS:
+            column = self.columns[field]
+            column[start:] = [sys.intern(x) if x else x for x in column[start:]]
+
+    def view(self, order):
+        """Collection of some of these rows, in the given order"""
+        other = TaskCollection.__new__(TaskCollection)
+        other.api = self.api
+        other.columns = self.columns
+        other.dates = self.dates
+        other.order = array.array('L', order)
+        return other
+
+    def column(self, field):
+        """All values of a field, indexed by row, dates parsed"""
+        if field not in DATE_FIELDS:
+            return self.columns[field]
+        parsed = self.dates.setdefault(field, [])
+        raw = self.columns[field]
+        fromisoformat = datetime.datetime.fromisoformat
+        parsed.extend([fromisoformat(x) if x else None for x in raw[len(parsed):]])
+        return parsed
+
+    @property
+    def rows(self):
+        """Row numbers of the tasks, in order"""
+        if self.order is None:
+            return range(len(self.columns['id']))
+        return self.order
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, position):
+        return self.task(self.rows[position])
+
+    def __iter__(self):
+        columns = [*self.columns.values()]
+        wakeups, dues = self.column('wakeup'), self.column('due')
+        if self.order is not None:
+            # NOTE copying the columns in order beats indexing them for every task
+            columns = [[x[i] for i in self.order] for x in columns]
+            wakeups, dues = [wakeups[i] for i in self.order], [dues[i] for i in self.order]
+        # NOTE from_values() inlined, this loop is most of the cost of a paper report
+        new, api = Task.__new__, self.api
+        for values, wakeup_at, due_at in zip(zip(*columns), wakeups, dues):
+            tsk = new(Task)
+            tsk.api, tsk.values, tsk.tid = api, values, values[0]
+            tsk.wakeup_at, tsk.due_at = wakeup_at, due_at
+            yield tsk
+
+    def task(self, row):
+        """Task for a row number, with the dates the collection has parsed"""
+        return Task.from_values(self.api, tuple([x[row] for x in self.columns.values()]),
+                                self.column('wakeup')[row], self.column('due')[row])
+
+    def filter(self, mode=None, context=None, priority=None, until=None):
+        """Tasks in a mode ('open' for all but closed) and context, with at least a
+        priority (none counts as 0) and woken up by until (a datetime, so not those
+        without a wakeup)
+        """
+        rows = self.rows
+        modes = self.columns['mode']
+        if mode == 'open':
+            rows = [x for x in rows if modes[x] != 'closed']
+        elif mode:
+            rows = [x for x in rows if modes[x] == mode]
+        if context:
+            contexts = self.columns['context']
+            rows = [x for x in rows if contexts[x] == context]
+        if priority is not None:
+            priorities = self.columns['priority']
+            rows = [x for x in rows if (priorities[x] or 0) >= priority]
+        if until:
+            wakeups = self.column('wakeup')
+            rows = [x for x in rows if wakeups[x] and wakeups[x] <= until]
+        return self.view(rows)
+
+    def sort(self, field, reverse=False):
+        """Tasks ordered by a field, those without it last
+
+        Modes go as in MODE_ORDER.  The sort is stable, so sort by the least
+        significant field first.
+        """
+        values = self.column(field)
+        if field == 'mode':
+            values = [MODE_ORDER.get(x, len(MODE_ORDER)) for x in values]
+        rows = [x for x in self.rows if values[x] is not None]
+        rows.sort(key=values.__getitem__, reverse=reverse)
+        return self.view(rows + [x for x in self.rows if values[x] is None])
+
+
+class ResponseCache:
+    """LRU cache of GET response bodies by URL and params, bounded by their total size
+
+    Entries are trusted for a TTL (the longest matching URL prefix in ttls,
+    else default_ttl) and after that kept, while there is room, to be
+    revalidated by ETag.  Counts hits, revalidated, misses, evictions and
+    invalidations in stats.
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES, ttls=None, default_ttl=0):
+        self.max_bytes = max_bytes
+        self.ttls = CACHE_TTLS if ttls is None else ttls
+        self.default_ttl = default_ttl
+        self.entries = collections.OrderedDict()  # NOTE key: [expires, etag, body]
+        self.size = 0
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(url, params=None):
+        """Cache key for a URL and its query params"""
+        return (url, tuple(sorted((params or {}).items())))
+
+    def ttl(self, url):
+        """Seconds a response for this URL is trusted"""
+        prefixes = [x for x in self.ttls if url.startswith(x)]
+        if not prefixes:
+            return self.default_ttl
+        return self.ttls[max(prefixes, key=len)]
+
+    def count(self, stat):
+        """Add one to a stat"""
+        with self.lock:
+            self.stats[stat] += 1
+
+    def lookup(self, key):
+        """Return (fresh, etag, body) for a key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0] > time.monotonic(), entry[1], entry[2]
+
+    def store(self, key, body, etag=None):
+        """Cache a response body, evicting the least recently used to stay in bounds"""
+        with self.lock:
+            self.drop(key)
+            if len(body) > self.max_bytes:
+                return
+            self.entries[key] = [time.monotonic() + self.ttl(key[0]), etag, body]
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    def refresh(self, key):
+        """Trust an entry for another TTL, after the server said it is unchanged"""
+        with self.lock:
+            if key in self.entries:
+                self.entries[key][0] = time.monotonic() + self.ttl(key[0])
+
+    def invalidate(self, *prefixes):
+        """Forget every entry whose URL starts with one of the prefixes"""
+        with self.lock:
+            for key in [x for x in self.entries if x[0].startswith(prefixes)]:
+                self.drop(key)
+                self.stats['invalidations'] += 1
+
+    def drop(self, key):
+        """Remove an entry, if present; caller holds the lock"""
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= len(entry[2])
+
+
 class TMApi:
     """TM API/list"""
 
-    def __init__(self, url):
-        self.tlcache = [None, None]
-        self.ctcache = [None, None]
+    def __init__(self, url, timeout=TIMEOUT, retries=3, backoff=0.3, pool_size=10, gzip=True,
+                 cache_bytes=CACHE_BYTES, cache_ttls=None):
+        """Connect to the API at url
+
+        Connections are kept alive and pooled (up to pool_size per host).
+        Idempotent calls (GET/PUT) are retried up to retries times with
+        exponential backoff on connection errors and 502/503/504; POST is not
+        retried.  Set gzip=False to ask for uncompressed responses.
+
+        GET responses are cached, see ResponseCache; cache_bytes=0 turns that off.
+
+        One TMApi may be shared between threads.
+        """
+        self.cache = ResponseCache(cache_bytes, cache_ttls)
         self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = urllib3.util.Retry(total=retries,
+                                   backoff_factor=backoff,
+                                   status_forcelist=(502, 503, 504),
+                                   raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size,
+                                                max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if not gzip:
+            self.session.headers['Accept-Encoding'] = 'identity'
+
+    def close(self):
+        """Close pooled connections"""
+        self.session.close()
+
+    def update_many(self, tasks, changes):
+        """Apply changes to several Task objects in one call, updating them in place
+
+        changes is one dictionary for all tasks or a list of them matching tasks
+        """
+        if isinstance(changes, dict):
+            changes = [changes] * len(tasks)
+        assert len(changes) == len(tasks)
+        if len(tasks) == 1:
+            tasks[0].update(changes[0])
+            return tasks
+        results = self.patch('tasks/', [{'id': tsk.tid, 'changes': chg}
+                                        for tsk, chg in zip(tasks, changes)])
+        for tsk, res in zip(tasks, results):
+            tsk.dct = res
+        return tasks
+
+    def close_many(self, tasks):
+        """Close several Task objects in one call, updating them in place"""
+        if len(tasks) == 1:
+            tasks[0].close()
+            return tasks
+        results = self.post('tasks/action', {'ids': [tsk.tid for tsk in tasks], 'close': True})
+        for tsk, res in zip(tasks, results):
+            tsk.dct = res
+        return tasks
 
     def post(self, url, data):
         """Run a post API"""
-        r = requests.post(self.url + url, json=data)
+        r = self.session.post(self.url + url, json=data, timeout=self.timeout)
         r.raise_for_status()
+        self.cache.invalidate('tasks/', 'timelines/')
         return r.json()
 
-    def get(self, url, params=None):
-        """Run a get API"""
-        r = requests.get(self.url + url, params)
+    def get(self, url, params=None, cache=True):
+        """Run a get API, from the cache if still fresh or unchanged on the server"""
+        if not cache:
+            r = self.session.get(self.url + url, params=params, timeout=self.timeout)
+            r.raise_for_status()
+            return r.json()
+        key = self.cache.key(url, params)
+        entry = self.cache.lookup(key)
+        if entry and entry[0]:
+            self.cache.count('hits')
+            return json.loads(entry[2])
+        headers = {'If-None-Match': entry[1]} if entry and entry[1] else None
+        r = self.session.get(self.url + url, params=params, headers=headers, timeout=self.timeout)
         r.raise_for_status()
+        if r.status_code == 304:
+            self.cache.count('revalidated')
+            self.cache.refresh(key)
+            return json.loads(entry[2])
+        self.cache.count('misses')
+        self.cache.store(key, r.content, r.headers.get('ETag'))
         return r.json()
 
     def put(self, url, data):
-        """Run a put/patch API"""
-        r = requests.put(self.url + url, json=data)
+        """Run a put/patch API
+
+        The response is the new state of the resource, so it is also cached for GET
+        """
+        r = self.session.put(self.url + url, json=data, timeout=self.timeout)
         r.raise_for_status()
+        self.cache.invalidate('tasks/', 'timelines/')
+        self.cache.store(self.cache.key(url), r.content, r.headers.get('ETag'))
+        return r.json()
+
+    def patch(self, url, data):
+        """Run a patch API"""
+        r = self.session.patch(self.url + url, json=data, timeout=self.timeout)
+        r.raise_for_status()
+        self.cache.invalidate('tasks/', 'timelines/')
         return r.json()
 
     def new_task(self, td):
@@ -192,11 +537,76 @@ class TMApi:
                 params['context'] = context
         return [Task(self, x) for x in self.get('tasks/', params)]
 
-    def search_tasks(self, task_search):
-        """Return Tasks matching a string"""
+    def task_collection(self, mode=None, until=None, context=None):
+        """All tasks as for all_tasks(), as a TaskCollection
+
+        Reads the NDJSON stream STREAM_BATCH lines at a time, bypassing the cache, so
+        only a batch of tasks is ever held as dictionaries
+        """
+        params = {'stream': 'true'}
+        if mode:
+            params['mode'] = mode
+            if until:
+                params['until'] = until.isoformat()
+            if context:
+                params['context'] = context
+        with self.session.get(self.url + 'tasks/', params=params, stream=True,
+                              timeout=self.timeout) as r:
+            r.raise_for_status()
+            if not r.headers.get('Content-Type', '').startswith('application/x-ndjson'):
+                return TaskCollection(self, r.json())  # NOTE server without stream
+            tasks = TaskCollection(self)
+            lines = []
+            for line in r.iter_lines(65536):
+                if line:
+                    lines.append(line)
+                if len(lines) == STREAM_BATCH:
+                    tasks.extend(json.loads(b'[' + b','.join(lines) + b']'))
+                    lines = []
+            tasks.extend(json.loads(b'[' + b','.join(lines) + b']'))
+        return tasks
+
+    def iter_tasks(self, mode='all', page=500):
+        """Yield Task objects a page at a time, 'all' by ID or 'closed' newest first"""
+        assert mode in ('all', 'closed')
+        params = {'mode': mode, 'limit': page}
+        while True:
+            tasks = self.get('tasks/', params)
+            for tsk in tasks:
+                yield Task(self, tsk)
+            if len(tasks) < page:
+                return
+            params['after_id'] = tasks[-1]['id']
+            if mode == 'closed':
+                params['closed_before'] = tasks[-1]['closed']
+
+    def changes(self, since=None):
+        """Return a cursor and the tasks changed since an earlier cursor (all tasks if None)
+
+        Cursors are the server's change sequence numbers, so no change is missed
+        """
+        params = {'since': since} if since is not None else None
+        result = self.get('tasks/changes', params, cache=False)
+        return result['cursor'], [Task(self, x) for x in result['tasks']]
+
+    def search_tasks(self, task_search, limit=None, offset=None, mode=None):
+        """Return Tasks with every word in a string, best match first
+
+        mode is 'open' (the server default) or 'all'
+        """
         params = {'search': task_search}
+        for key, value in (('limit', limit), ('offset', offset), ('mode', mode)):
+            if value is not None:
+                params[key] = value
         return [Task(self, x) for x in self.get('tasks/', params)]
 
+    def similar_tasks(self, tid, limit=10, mode=None):
+        """Return Tasks sharing words with the name of a given task ID, best match first"""
+        params = {'limit': limit}
+        if mode:
+            params['mode'] = mode
+        return [Task(self, x) for x in self.get('tasks/' + str(tid) + '/similar', params)]
+
     def one_task(self, tid):
         """Return one task, given an ID"""
         return Task(self, self.get('tasks/' + str(tid)))
@@ -223,15 +633,23 @@ class TMApi:
     def timelines(self, get_all=False, force_refresh=False):
         """Return commonly used timelines"""
         if force_refresh:
-            self.tlcache = [None, None]
-        if not self.tlcache[0] \
-                or self.tlcache[0] <= datetime.datetime.now() - datetime.timedelta(minutes=1):
-            self.tlcache[0] = datetime.datetime.now()
-            self.tlcache[1] = [datetime.datetime.fromisoformat(x['timeline'])
-                               for x in self.get('timelines/')]
+            self.cache.invalidate('timelines/')
+        timelines = [datetime.datetime.fromisoformat(x['timeline'])
+                     for x in self.get('timelines/')]
         if get_all:
-            return self.tlcache[1]
-        return self.tlcache[1][0:3]
+            return timelines
+        return timelines[0:3]
+
+    def timeline_counts(self, kind='wakeup', context=None):
+        """Return (datetime, count) of future wakeup or due times, most used first
+
+        Optionally only count tasks in one context
+        """
+        params = {'type': kind}
+        if context:
+            params['context'] = context
+        return [(datetime.datetime.fromisoformat(x['timeline']), x['count'])
+                for x in self.get('timelines/', params)]
 
     def timelines_native(self, force_refresh=False):
         """All timelines in order"""
@@ -239,8 +657,130 @@ class TMApi:
 
     def contexts(self):
         """Return valid contexts"""
-        if not self.ctcache[0] \
-                or self.ctcache[0] <= datetime.datetime.now() - datetime.timedelta(minutes=2):
-            self.ctcache[0] = datetime.datetime.now()
-            self.ctcache[1] = self.get('contexts/')
-        return self.ctcache[1]
+        return self.get('contexts/')
+
+
+class TaskReplica:
+    """Local copy of all tasks, kept current by fetching only what changed
+
+    Modes are as the server saw them at the last sync that returned each task
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.cursor = None
+        self.tasks = {}
+        self.lock = threading.Lock()
+
+    def sync(self):
+        """Fetch changes since the last sync (everything the first time)
+
+        Returns the changed tasks
+        """
+        with self.lock:
+            cursor, changed = self.api.changes(self.cursor)
+            for tsk in changed:
+                self.tasks[tsk.tid] = tsk
+            self.cursor = cursor
+        return changed
+
+    def one_task(self, tid):
+        """Get a task from the replica"""
+        return self.tasks[tid]
+
+    def all_tasks(self, mode=None, context=None):
+        """Tasks by ID, optionally only one mode (or 'open' for all but closed) and context"""
+        with self.lock:
+            tasks = [self.tasks[x] for x in sorted(self.tasks)]
+        if mode == 'open':
+            tasks = [x for x in tasks if x['mode'] != 'closed']
+        elif mode:
+            tasks = [x for x in tasks if x['mode'] == mode]
+        if context:
+            tasks = [x for x in tasks if x['context'] == context]
+        return tasks
+
+
+class AsyncTMApi:
+    """TM API for asyncio, to fan out many calls at once"""
+
+    def __init__(self, url, timeout=TIMEOUT, retries=3, concurrency=10, gzip=True):
+        """Connect to the API at url
+
+        At most concurrency requests are in flight at a time.  Connection
+        errors are retried up to retries times.  Use as an async context
+        manager or call aclose() when done.
+        """
+        self.url = url
+        self.limit = asyncio.Semaphore(concurrency)
+        headers = None if gzip else {'Accept-Encoding': 'identity'}
+        self.client = httpx.AsyncClient(
+            base_url=url,
+            headers=headers,
+            timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+            limits=httpx.Limits(max_connections=concurrency,
+                                max_keepalive_connections=concurrency),
+            transport=httpx.AsyncHTTPTransport(retries=retries))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        """Close pooled connections"""
+        await self.client.aclose()
+
+    async def request(self, method, url, **kwargs):
+        """Run an API call and return the JSON result"""
+        async with self.limit:
+            r = await self.client.request(method, url, **kwargs)
+        r.raise_for_status()
+        return r.json()
+
+    async def get(self, url, params=None):
+        """Run a get API"""
+        return await self.request('GET', url, params=params)
+
+    async def post(self, url, data):
+        """Run a post API"""
+        return await self.request('POST', url, json=data)
+
+    async def put(self, url, data):
+        """Run a put/patch API"""
+        return await self.request('PUT', url, json=data)
+
+    async def one_task(self, tid):
+        """Return one task dictionary, given an ID"""
+        return await self.get('tasks/' + str(tid))
+
+    async def update_task(self, tid, newdata):
+        """Do a PUT/PATCH of a given task with dictionary"""
+        return await self.put('tasks/' + str(tid), newdata)
+
+    async def close_task(self, tid, duplicate=False):
+        """Close a given task with ID, optionally also duplicating it"""
+        return await self.post('tasks/' + str(tid) + '/action',
+                               {'close': True, 'duplicate': duplicate})
+
+    async def update_many(self, tasks, changes):
+        """Apply changes to Task objects concurrently, updating them in place
+
+        changes is one dictionary for all tasks or a list of them matching tasks
+        """
+        if isinstance(changes, dict):
+            changes = [changes] * len(tasks)
+        assert len(changes) == len(tasks)
+        results = await asyncio.gather(*[self.update_task(tsk.tid, chg)
+                                         for tsk, chg in zip(tasks, changes)])
+        for tsk, res in zip(tasks, results):
+            tsk.dct = res
+        return tasks
+
+    async def close_many(self, tasks, duplicate=False):
+        """Close Task objects concurrently, updating them in place"""
+        results = await asyncio.gather(*[self.close_task(tsk.tid, duplicate) for tsk in tasks])
+        for tsk, res in zip(tasks, results):
+            tsk.dct = res[0]
+        return tasks
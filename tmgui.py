@@ -3,7 +3,8 @@
 import secrets
 import datetime
 import os
-from flask import Flask, g, flash, session, request, render_template, redirect, url_for
+import threading
+from flask import Flask, flash, session, request, render_template, redirect, url_for
 import tmclilib
 
 DATE_FMT = "%a %d %b"
@@ -11,11 +12,16 @@ DATE_FMT = "%a %d %b"
 app = Flask(__name__)
 app.secret_key = secrets.token_hex()
 
+API = None
+API_LOCK = threading.Lock()
+
 def get_api():
-    """Get TM Client object"""
-    if 'api' not in g:
-        g.api = tmclilib.TMApi(os.environ['TMAPIURL'])
-    return g.api
+    """Get the TM Client object shared by all requests (and its pool and caches)"""
+    global API
+    with API_LOCK:
+        if API is None:
+            API = tmclilib.TMApi(os.environ['TMAPIURL'])
+    return API
 
 
 
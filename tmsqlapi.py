@@ -1,9 +1,54 @@
 """Task Master RESTful API to SQL database"""
 
 import datetime
+import re
+import threading
 import flask
 import flask_restx
 import flask_sqlalchemy
+import apimetrics
+import apiprofile
+import fastjson
+
+# Full text index over task names, kept in sync by triggers (SQLite FTS5 only)
+SEARCH_DDL = ["CREATE VIRTUAL TABLE task_fts USING fts5(name, content='task', content_rowid='id')",
+              "CREATE TRIGGER task_fts_insert AFTER INSERT ON task BEGIN "
+              "INSERT INTO task_fts(rowid, name) VALUES (new.id, new.name); END",
+              "CREATE TRIGGER task_fts_delete AFTER DELETE ON task BEGIN "
+              "INSERT INTO task_fts(task_fts, rowid, name) VALUES ('delete', old.id, old.name); END",
+              "CREATE TRIGGER task_fts_update AFTER UPDATE OF name ON task BEGIN "
+              "INSERT INTO task_fts(task_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+              "INSERT INTO task_fts(rowid, name) VALUES (new.id, new.name); END",
+              "INSERT INTO task_fts(task_fts) VALUES ('rebuild')"]
+
+# Count of open tasks per wakeup or due time and context, kept in sync by triggers (SQLite only)
+TIMELINE_KINDS = ('wakeup', 'due')
+TIMELINE_ADD = ("INSERT INTO timeline (kind, context, at, count) "
+                "SELECT '{kind}', coalesce(new.context, ''), new.{kind}, 1 "
+                "WHERE new.closed IS NULL AND new.{kind} IS NOT NULL "
+                "ON CONFLICT (kind, context, at) DO UPDATE SET count = count + 1;")
+TIMELINE_REMOVE = ("UPDATE timeline SET count = count - 1 WHERE old.closed IS NULL "
+                   "AND kind = '{kind}' AND context = coalesce(old.context, '') AND at = old.{kind}; "
+                   "DELETE FROM timeline WHERE count <= 0 "
+                   "AND kind = '{kind}' AND context = coalesce(old.context, '') AND at = old.{kind};")
+TIMELINE_DDL = ["CREATE TRIGGER timeline_insert AFTER INSERT ON task BEGIN {} END".format(
+                    ' '.join(TIMELINE_ADD.format(kind=x) for x in TIMELINE_KINDS)),
+                "CREATE TRIGGER timeline_delete AFTER DELETE ON task BEGIN {} END".format(
+                    ' '.join(TIMELINE_REMOVE.format(kind=x) for x in TIMELINE_KINDS)),
+                "CREATE TRIGGER timeline_update AFTER UPDATE OF wakeup, due, context, closed ON task "
+                "BEGIN {} {} END".format(' '.join(TIMELINE_REMOVE.format(kind=x) for x in TIMELINE_KINDS),
+                                         ' '.join(TIMELINE_ADD.format(kind=x) for x in TIMELINE_KINDS)),
+                "DELETE FROM timeline"] + [
+                "INSERT INTO timeline (kind, context, at, count) "
+                "SELECT '{kind}', coalesce(context, ''), {kind}, count(*) FROM task "
+                "WHERE closed IS NULL AND {kind} IS NOT NULL "
+                "GROUP BY coalesce(context, ''), {kind}".format(kind=x) for x in TIMELINE_KINDS]
+
+# Rows fetched from the DB cursor at a time when streaming NDJSON
+STREAM_CHUNK = 500
+# Every insert or update stamps a task with the next change sequence number for /tasks/changes
+# NOTE computed inside the write, so under SQLite's write lock it follows commit order
+NEXT_SEQ = "(SELECT coalesce(max(seq), 0) + 1 FROM task)"
 
 # Possible contexts
 CTX = ['hmdy', 'hmed', 'wknw', 'hmfm', 'wkin', 'wkof', 'errd', 'trip', 'hmid', 'wkid']
@@ -15,6 +60,94 @@ db = flask_sqlalchemy.SQLAlchemy(app)
 
 api = flask_restx.Api(app, version='0.1', title='TaskMaster API', description='API for interacting with a TaskMaster DB')#, validate=True) TODO validate
 
+class FastJSONResponse(fastjson.FastJSON, flask.Response):
+    """JSON response encoded with orjson, for rows already in the shape of a model"""
+
+@app.after_request
+def conditional(response):
+    """Tag JSON responses with an ETag, and answer a GET with 304 if the client has it already"""
+    if response.status_code in (200, 201) and response.mimetype == 'application/json' \
+            and not response.is_streamed:
+        response.add_etag()
+        if flask.request.method == 'GET':
+            response.make_conditional(flask.request)
+    return response
+
+# Set METRICS = True in the settings to time requests and count their SQL, see /metrics
+metrics = apimetrics.Metrics('tmsqlapi')
+
+if app.config.get('METRICS'):
+    @app.before_request
+    def metrics_begin():
+        """Start timing the request"""
+        flask.g.metrics = metrics.begin()
+        flask.g.metrics_response = (500, None)
+
+    @app.after_request
+    def metrics_header(response):
+        """Add a Server-Timing header; for streams it covers the time to the first byte"""
+        response.headers['Server-Timing'] = flask.g.metrics.server_timing()
+        flask.g.metrics_response = (response.status_code,
+                                    None if response.is_streamed else response.content_length)
+        flask.g.metrics_streamed = response.is_streamed
+        return response
+
+    @app.teardown_request
+    def metrics_end(_exc):
+        """Record the request, after any stream has been sent"""
+        if flask.g.pop('metrics_streamed', False):
+            return  # NOTE teardown runs again once a stream_with_context is sent
+        stats = flask.g.pop('metrics', None)
+        if stats is None:
+            return
+        rule = flask.request.url_rule
+        metrics.end(stats, flask.request.method, rule.rule if rule else 'unmatched',
+                    *flask.g.metrics_response)
+
+    @app.route('/metrics')
+    def get_metrics():
+        """Request metrics in the Prometheus text format"""
+        return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Set PROFILE_RATE (a fraction of requests) or PROFILE_HEADER = True (requests sent with
+# X-Profile) in the settings to keep profiles of slow requests, see apiprofile
+profiler = apiprofile.Profiler(app.config.get('PROFILE_DIR', apiprofile.PROFILE_DIR),
+                               app.config.get('PROFILE_RATE', 0.0),
+                               app.config.get('PROFILE_HEADER', False),
+                               app.config.get('PROFILE_THRESHOLD', 0.1),
+                               app.config.get('PROFILE_KEEP', 100))
+
+if profiler.enabled:
+    @app.before_request
+    def profile_begin():
+        """Start sampling this thread if the request is to be profiled"""
+        flask.g.profile = profiler.begin(apiprofile.HEADER in flask.request.headers,
+                                         threading.get_ident())
+        flask.g.profile_status = 500
+
+    @app.after_request
+    def profile_header(response):
+        """Tell the client which profile it asked for"""
+        profile = flask.g.get('profile')
+        if profile:
+            if profile.forced:
+                response.headers[apiprofile.ID_HEADER] = profile.id
+            flask.g.profile_status = response.status_code
+            flask.g.profile_streamed = response.is_streamed
+        return response
+
+    @app.teardown_request
+    def profile_end(_exc):
+        """Save the profile if slow, after any stream has been sent"""
+        if flask.g.pop('profile_streamed', False):
+            return  # NOTE teardown runs again once a stream_with_context is sent
+        profile = flask.g.pop('profile', None)
+        if profile is None:
+            return
+        rule = flask.request.url_rule
+        profiler.end(profile, flask.request.method, flask.request.full_path.rstrip('?'),
+                     rule.rule if rule else 'unmatched', flask.g.profile_status)
+
 taskns = api.namespace('tasks', description='TODO operations')
 tmlnns = api.namespace('timelines', description='Timelines')
 ctxns = api.namespace('contexts', description='Contexts')
@@ -39,7 +172,12 @@ task = api.model('Task', {'id': flask_restx.fields.Integer(readonly=True, descri
 
 action = api.model('Action', {'close': flask_restx.fields.Boolean(description='Close task', default=False),
                               'duplicate': flask_restx.fields.Boolean(description='Duplicate task', default=False)})
-timeline = api.model('Timeline', {'timeline': flask_restx.fields.DateTime(description='Timeline'),
+change = api.model('Change', {'id': flask_restx.fields.Integer(required=True, description='Task ID'),
+                              'changes': flask_restx.fields.Raw(required=True, description='Fields to update, as for PUT')})
+batch_action = api.inherit('BatchAction', action, {'ids': flask_restx.fields.List(flask_restx.fields.Integer, required=True, description='Task IDs')})
+changeset = api.model('Changes', {'cursor': flask_restx.fields.Integer(description='Pass as since to get later changes'),
+                                   'tasks': flask_restx.fields.List(flask_restx.fields.Nested(task))})
+timeline = api.model('Timeline', {'timeline': flask_restx.fields.DateTime(description='Timeline', attribute='at'),
                                   'count': flask_restx.fields.Integer(description='How many times it is used')})
 
 
@@ -67,6 +205,28 @@ class Task(db.Model):
     #dependency_id = db.Column(db.Integer, db.ForeignKey('task.id'))
     #nexttasks = db.relationship('Person')
     due = db.Column(db.DateTime)
+    seq = db.Column(db.Integer, default=db.text(NEXT_SEQ), onupdate=db.text(NEXT_SEQ))
+    # Most listings only look at open tasks, so index those where the DB supports partial indexes
+    __table_args__ = (db.Index('ix_task_seq', 'seq'),
+                      db.Index('ix_task_closed', 'closed',
+                               sqlite_where=db.text('closed IS NOT NULL'),
+                               postgresql_where=db.text('closed IS NOT NULL')),
+                      db.Index('ix_task_open_wakeup', 'wakeup',
+                               sqlite_where=db.text('closed IS NULL'),
+                               postgresql_where=db.text('closed IS NULL')),
+                      db.Index('ix_task_open_context_wakeup', 'context', 'wakeup',
+                               sqlite_where=db.text('closed IS NULL'),
+                               postgresql_where=db.text('closed IS NULL')),
+                      db.Index('ix_task_open_warm', 'warm', 'frog', 'priority',
+                               sqlite_where=db.text('closed IS NULL'),
+                               postgresql_where=db.text('closed IS NULL')))
+
+class Timeline(db.Model):
+    """How many open tasks wake up (or are due) at a time in a context, see TIMELINE_DDL"""
+    kind = db.Column(db.String(8), primary_key=True)
+    context = db.Column(db.String(8), primary_key=True)  # NOTE '' for no context
+    at = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
 
 def taskmode(mytask, upper=None, fut=None):
     """Determine mode field
@@ -116,29 +276,121 @@ def taskmode(mytask, upper=None, fut=None):
 
 
 
+def task_changes(mytask, changes):
+    """Validate a PUT/PATCH dictionary against a task, return the attributes to set
+
+    Does not modify the task, so a whole batch can be checked before any of it is applied
+    """
+    newvals = {}
+    for key, value in changes.items():
+        if key in ['name', 'priority', 'urgent', 'important', 'frog', 'pomodoros', 'warm']:
+            newvals[key] = value
+        elif key in ['wakeup', 'due']: # TODO is this the best way?
+            newvals[key] = datetime.datetime.fromisoformat(value) # TODO timezone?
+            # TODO keeping this seperate in case above used to deal with other timelike attributes
+            if key == 'wakeup' and newvals[key] > datetime.datetime.now():
+                newvals['warm'] = False
+        elif key == 'context':
+            assert value in CTX
+            newvals[key] = value
+        else:
+            flask_restx.abort(403)
+    due = newvals.get('due', mytask.due)
+    wakeup = newvals.get('wakeup', mytask.wakeup)
+    if due and wakeup:
+        assert due > wakeup
+    return newvals
+
+def get_many_or_404(ids):
+    """Return tasks in the same order as the given IDs, or abort if any are missing"""
+    assert len(set(ids)) == len(ids)
+    found = {x.id: x for x in Task.query.filter(Task.id.in_(ids)).all()}
+    if len(found) != len(ids):
+        flask_restx.abort(404, 'Tasks not found: {}'.format(sorted(set(ids) - set(found))))
+    return [found[x] for x in ids]
+
 def mode_one(mytask, upper=None, fut=None):
     """Add mode field to one task"""
-    onemode = taskmode(mytask, upper, fut=fut)
-    onedict = dict(mytask.__dict__)
-    onedict['mode'] = onemode
+    onedict = {x.key: getattr(mytask, x.key) for x in Task.__table__.columns}
+    onedict['mode'] = taskmode(mytask, upper, fut=fut)
     return onedict
 
 def mode_many(mytasks, upper=None, fut=None):
     """Add mode field to many tasks"""
     return [mode_one(x, upper, fut=fut) for x in mytasks]
 
-def modesort(itema):
-    """Return a numerical value for the mode of the task"""
-    if itema['mode'] == 'overdue':
-        return (0, None, None)
-    if itema['mode'] == 'warm':
-        return (1, not itema['urgent'], not itema['important'])
-    if itema['mode'] == 'awake':
-        return (2, not itema['urgent'], not itema['important'])
-    if itema['mode'] == 'asleep':
-        return (3, itema['wakeup'], None)
-    # triage, schedule, etc
-    return (4, None, None)
+def mode_case(fut=None):
+    """SQL equivalent of taskmode(), without the 'upper' checks"""
+    if not fut:
+        fut = datetime.datetime.now()
+    return db.case((Task.closed != None, 'closed'),
+                   (Task.due < fut, 'overdue'),
+                   (Task.warm == True, 'warm'),
+                   (Task.wakeup <= fut, 'awake'),
+                   (Task.wakeup > fut, 'asleep'),
+                   ((Task.pomodoros != None) & (Task.urgent != None) & (Task.important != None), 'schedule'),
+                   else_='triage')
+
+def mode_order(fut=None):
+    """SQL ORDER BY for printing: overdue, warm, awake, asleep, then the rest
+
+    Warm and awake tasks go urgent then important first, asleep ones by wakeup
+    """
+    mode = mode_case(fut)
+    rank = db.case((mode == 'overdue', 0), (mode == 'warm', 1), (mode == 'awake', 2),
+                   (mode == 'asleep', 3), else_=4)
+    active = mode.in_(['warm', 'awake'])
+    return [rank,
+            db.case((active, db.func.coalesce(Task.urgent, False)), else_=None).desc(),
+            db.case((active, db.func.coalesce(Task.important, False)), else_=None).desc(),
+            Task.wakeup]
+
+def mode_query(fut=None):
+    """Select the fields of the task model, with the mode computed by the DB"""
+    mode = mode_case(fut).label('mode')
+    return db.select(*[mode if x == 'mode' else Task.__table__.c[x] for x in task])
+
+def mode_rows(query):
+    """Run a mode_query() and return task dictionaries, as marshalled with the task model"""
+    result = db.session.execute(query)
+    return fastjson.records(result.keys(), result)
+
+def mode_where(*criteria, order_by=(), fut=None):
+    """Select tasks matching criteria, with the mode computed by the DB"""
+    return mode_query(fut).where(*criteria).order_by(*order_by)
+
+def mode_stream(query):
+    """Yield the rows of a mode_query() as NDJSON lines, from a server side cursor
+
+    Lines are sent STREAM_CHUNK at a time, rather than a write per task
+    """
+    result = db.session.execute(query.execution_options(yield_per=STREAM_CHUNK))
+    keys = tuple(result.keys())
+    for rows in result.partitions():
+        yield b''.join([fastjson.dumps(dict(zip(keys, x))) + b'\n' for x in rows])
+
+def search_terms(text, any_word=False):
+    """Words in text as an FTS5 query, every word (as a prefix) by default or any whole word"""
+    words = re.findall(r'\w+', text)
+    if any_word:
+        return ' OR '.join('"{}"'.format(x) for x in words if len(x) > 2)
+    return ' '.join('"{}"*'.format(x) for x in words)
+
+def search_query(text, *criteria, any_word=False, limit=None, offset=None):
+    """Select tasks whose name matches text, best match first
+
+    Falls back to an unranked LIKE where there is no FTS5 index
+    """
+    query = mode_query().where(*criteria).limit(limit).offset(offset)
+    terms = search_terms(text, any_word)
+    if db.engine.dialect.name != 'sqlite':
+        words = re.findall(r'\w+', text)
+        match = db.or_ if any_word else db.and_
+        return query.where(match(*[Task.name.like("%{}%".format(x)) for x in words])).order_by(Task.id.desc())
+    if not terms:
+        return query.where(db.false())
+    task_fts = db.table('task_fts', db.column('rowid'), db.column('rank'), db.column('task_fts'))
+    return query.join(task_fts, task_fts.c.rowid == Task.id).where(task_fts.c.task_fts.op('MATCH')(terms)).order_by(task_fts.c.rank)
 
 @taskns.route('/')
 class TaskList(flask_restx.Resource):
@@ -146,18 +398,37 @@ class TaskList(flask_restx.Resource):
 
     # TODO swagger document mode param
     @taskns.doc('list_tasks')
-    @taskns.marshal_list_with(task)
+    @taskns.response(200, 'Success', [task])
     def get(self):
-        """Get all tasks"""
+        """Get all tasks
+
+        mode=all (by ID) and mode=closed (newest first) page with limit plus
+        after_id, or closed_before and after_id of the last task for closed.
+        Set stream to get NDJSON, one task per line, instead of one JSON list.
+        """
         parser = flask_restx.reqparse.RequestParser() # TODO better way to call this?
         # TODO document these options
         parser.add_argument('mode', choices=('triage', 'schedule', 'stage', 'execute', 'all', 'open', 'closed', 'paper'), default='open')
         parser.add_argument('until', type=flask_restx.inputs.datetime_from_iso8601)
         parser.add_argument('search')
+        parser.add_argument('limit', type=int)
+        parser.add_argument('offset', type=int)
+        parser.add_argument('after_id', type=int)
+        parser.add_argument('closed_before', type=flask_restx.inputs.datetime_from_iso8601)
+        parser.add_argument('stream', type=flask_restx.inputs.boolean, default=False)
         parser.add_argument('context')
         # TODO support just date only
         # TODO support for status report "since"
         args = parser.parse_args()
+        query = self.tasks_query(args)
+        if args['stream']:
+            return flask.Response(flask.stream_with_context(mode_stream(query)),
+                                  mimetype='application/x-ndjson')
+        return FastJSONResponse(mode_rows(query))
+
+    @staticmethod
+    def tasks_query(args):
+        """Select the tasks for GET"""
         mymo = args['mode']
         assert mymo
         if args.get('context'):
@@ -166,69 +437,63 @@ class TaskList(flask_restx.Resource):
         if args.get('search'):
             # TODO integrate search better into the other modes
             assert mymo in ('all', 'open')
-            if mymo == 'all':
-                return mode_many(Task.query.filter(Task.name.like("%{}%".format(args['search']))).all(), 'all')
-            else:
-                return mode_many(Task.query.filter(Task.closed == None, Task.name.like("%{}%".format(args['search']))).all(), 'open')
+            criteria = [] if mymo == 'all' else [Task.closed == None]
+            return search_query(args['search'], *criteria, limit=args['limit'], offset=args['offset'])
+        if args['after_id'] is not None or args['closed_before']:
+            assert mymo in ('all', 'closed')
         if mymo == 'all':
-            return mode_many(Task.query.all(), 'all')
+            criteria = []
+            if args['after_id'] is not None:
+                criteria.append(Task.id > args['after_id'])
+            return mode_where(*criteria, order_by=[Task.id]).limit(args['limit'])
         if mymo == 'open':
-            return mode_many(Task.query.filter_by(closed=None).all(), 'open')
+            return mode_where(Task.closed == None)
         if mymo == 'closed':
-            return mode_many(Task.query.filter(Task.closed != None).order_by(Task.closed.desc()).all(), 'closed')
+            criteria = [Task.closed != None]
+            if args['closed_before'] and args['after_id'] is not None:
+                # NOTE batch actions close many tasks at the same instant, so break ties by ID
+                criteria.append((Task.closed < args['closed_before'])
+                                | ((Task.closed == args['closed_before']) & (Task.id < args['after_id'])))
+            elif args['closed_before']:
+                criteria.append(Task.closed < args['closed_before'])
+            return mode_where(*criteria, order_by=[Task.closed.desc(), Task.id.desc()]).limit(args['limit'])
         if mymo == 'execute':
             # TODO accept a context? or warm stays warm always?
-            return mode_many(Task.query.filter_by(warm=True, closed=None).order_by(Task.frog.desc(), Task.priority.desc()).all(), 'execute')
+            return mode_where(Task.warm == True, Task.closed == None,
+                              order_by=[Task.frog.desc(), Task.priority.desc()])
         if mymo == 'stage':
             # TODO should this include warm?
             comprar = datetime.datetime.now()
             if args['until']:
                 comprar = args['until']
+            criteria = [Task.closed == None, Task.wakeup <= comprar]
             if args['context']:
-                mtl = Task.query.filter(Task.closed == None,
-                                        Task.context == args['context'],
-                                        Task.wakeup <= comprar).order_by(Task.frog.desc(),
-                                                                         Task.priority.desc(),
-                                                                         Task.urgent.desc(),
-                                                                         Task.important.desc()).all()
-            else:
-                mtl = Task.query.filter(Task.closed == None,
-                                        Task.wakeup <= comprar).order_by(Task.frog.desc(),
-                                                                         Task.priority.desc(),
-                                                                         Task.urgent.desc(),
-                                                                         Task.important.desc()).all()
-            return mode_many(mtl, 'stage', fut=comprar)
+                criteria.append(Task.context == args['context'])
+            return mode_where(*criteria,
+                              order_by=[Task.frog.desc(), Task.priority.desc(),
+                                        Task.urgent.desc(), Task.important.desc()],
+                              fut=comprar)
         if mymo == 'paper':
             comprar = datetime.datetime.now() + datetime.timedelta(days=1)
             if args['until']:
                 comprar = args['until']
+            # TODO add a "paper" "upper"
+            criteria = [Task.closed == None, ((Task.wakeup == None) | (Task.wakeup <= comprar))]
             if args['context']:
-                baselist = mode_many(Task.query.filter(Task.closed == None,
-                                                       ((Task.wakeup == None) | (Task.wakeup <= comprar)),
-                                                       ((Task.context == None) | (Task.context == args['context']) | (Task.due <= comprar))).order_by(Task.wakeup).all(),
-                                     None)
-                baselist.sort(key=modesort)
-                return baselist                
-            # TODO add a "paper" "upper"                
-            baselist = mode_many(Task.query.filter(Task.closed == None,
-                                                   ((Task.wakeup == None) | (Task.wakeup <= comprar))).order_by(Task.wakeup).all(),
-                                 None)
-            baselist.sort(key=modesort)
-            return baselist
+                criteria.append((Task.context == None) | (Task.context == args['context']) | (Task.due <= comprar))
+            return mode_where(*criteria, order_by=mode_order())
         if mymo == 'schedule':
             # TODO also put in overdue
             # TODO should this include current schedule
             # TODO allow context filter?
-            return mode_many(Task.query.filter(Task.closed == None,
-                                               Task.warm == False,
-                                               Task.wakeup == None).order_by(Task.important.desc(),
-                                                                             Task.urgent.desc()).all(),
-                             'schedule')
+            return mode_where(Task.closed == None,
+                              Task.warm == False,
+                              Task.wakeup == None,
+                              order_by=[Task.important.desc(), Task.urgent.desc()])
         if mymo == 'triage':
             # TODO look for missing tags here, especially context
-            return mode_many(Task.query.filter(Task.closed == None,
-                                               ((Task.pomodoros == None) | (Task.urgent == None) | (Task.important == None))).all(),
-                             'triage')
+            return mode_where(Task.closed == None,
+                              ((Task.pomodoros == None) | (Task.urgent == None) | (Task.important == None)))
         assert False
 
     @taskns.doc('create_task')
@@ -252,6 +517,76 @@ class TaskList(flask_restx.Resource):
         db.session.commit()
         return mode_one(newtask), 201
 
+    @taskns.doc('patch_tasks')
+    @taskns.expect([change])
+    @taskns.marshal_list_with(task)
+    def patch(self):
+        """Update many tasks in one transaction
+
+        Every change is validated before any is applied
+        """
+        mytasks = get_many_or_404([x['id'] for x in api.payload])
+        newvals = [task_changes(mytask, x['changes']) for mytask, x in zip(mytasks, api.payload)]
+        for mytask, vals in zip(mytasks, newvals):
+            for key, value in vals.items():
+                setattr(mytask, key, value)
+        db.session.commit()
+        # NOTE re-select in one query, the commit expired each task
+        return mode_many(get_many_or_404([x['id'] for x in api.payload]))
+
+
+@taskns.route('/action')
+class TaskListAction(flask_restx.Resource):
+    """API to take action on many tasks"""
+
+    @taskns.doc('action_tasks')
+    @taskns.expect(batch_action)
+    @taskns.marshal_list_with(task)
+    def post(self):
+        """Close and/or duplicate many tasks in one transaction
+
+        Returns the tasks in the order given, followed by any duplicates
+        """
+        mytasks = get_many_or_404(api.payload['ids'])
+        newtasks = []
+        if api.payload.get('duplicate'):
+            newtasks = [Task(name=x.name) for x in mytasks]
+            db.session.add_all(newtasks)
+        if api.payload.get('close'):
+            now = datetime.datetime.now()
+            for mytask in mytasks:
+                mytask.closed = now
+        db.session.flush()
+        ids = [x.id for x in mytasks + newtasks]
+        db.session.commit()
+        # NOTE re-select in one query, the commit expired each task
+        return mode_many(get_many_or_404(ids))
+
+
+@taskns.route('/changes')
+class TaskChanges(flask_restx.Resource):
+    """API for syncing a copy of the tasks"""
+
+    @taskns.doc('task_changes')
+    @taskns.response(200, 'Success', changeset)
+    def get(self):
+        """Get tasks created, updated or closed since a cursor, or all tasks without one
+
+        Pass the returned cursor as since next time.  Cursors are change sequence
+        numbers (see NEXT_SEQ), not times, so clock changes and slow commits can't
+        skip a change.  Deleted tasks are not reported.
+        """
+        parser = flask_restx.reqparse.RequestParser()
+        parser.add_argument('since', type=int)
+        args = parser.parse_args()
+        # NOTE read first, so a change committed meanwhile is in the next delta too
+        cursor = db.session.execute(db.select(db.func.max(Task.seq))).scalar() or 0
+        if args['since'] is None:
+            rows = mode_rows(mode_where(order_by=[Task.id]))
+        else:
+            rows = mode_rows(mode_where(Task.seq > args['since'], order_by=[Task.seq]))
+        return FastJSONResponse({'cursor': cursor, 'tasks': rows})
+
 
 @taskns.route('/<int:id>')
 @taskns.response(404, 'Task not found')
@@ -272,25 +607,36 @@ class TodoOne(flask_restx.Resource):
         """Update one task"""
         # TODO should this be PATCH?
         mytask = Task.query.get_or_404(id)
-        for key, value in api.payload.items():
-            if key in ['name', 'priority', 'urgent', 'important', 'frog', 'pomodoros', 'warm']:
-                setattr(mytask, key, value)
-            elif key in ['wakeup', 'due']: # TODO is this the best way?
-                setattr(mytask, key, datetime.datetime.fromisoformat(value)) # TODO timezone?
-                # TODO keeping this seperate in case above used to deal with other timelike attributes
-                if key == 'wakeup' and datetime.datetime.fromisoformat(value) > datetime.datetime.now():
-                    mytask.warm = False
-            elif key == 'context':
-                assert value in CTX
-                mytask.context = value
-            else:
-                flask_restx.abort(403)
-        if mytask.due and mytask.wakeup:
-            assert mytask.due > mytask.wakeup
+        for key, value in task_changes(mytask, api.payload).items():
+            setattr(mytask, key, value)
         db.session.commit()
         return mode_one(mytask)
 
 
+@taskns.route('/<int:id>/similar')
+@taskns.response(404, 'Task not found')
+@taskns.param('id', 'Task ID')
+class TodoSimilar(flask_restx.Resource):
+    """API to find tasks like a task"""
+
+    @taskns.doc('similar_tasks')
+    @taskns.response(200, 'Success', [task])
+    def get(self, id):
+        """Get tasks sharing words with this one's name, best match first"""
+        parser = flask_restx.reqparse.RequestParser()
+        parser.add_argument('mode', choices=('all', 'open'), default='open')
+        parser.add_argument('limit', type=int, default=10)
+        parser.add_argument('offset', type=int)
+        args = parser.parse_args()
+        mytask = Task.query.get_or_404(id)
+        criteria = [Task.id != id]
+        if args['mode'] == 'open':
+            criteria.append(Task.closed == None)
+        return FastJSONResponse(mode_rows(search_query(mytask.name, *criteria, any_word=True,
+                                                       limit=args['limit'],
+                                                       offset=args['offset'])))
+
+
 @taskns.route('/<int:id>/action')
 @taskns.response(404, 'Task not found')
 @taskns.param('id', 'Task ID')
@@ -325,18 +671,30 @@ class TimelineList(flask_restx.Resource):
     @taskns.doc('list_timelines')
     @taskns.marshal_list_with(timeline)
     def get(self):
-        """Auto-generated timeline list"""
-        # TODO show timelines per context (i.e. take a ctx arg and show what timelines are in that context only)
-        # TODO allow listing due timelines
+        """Auto-generated timeline list, most used first
+
+        type is wakeup or due; set context to count only tasks in that context
+        """
         parser = flask_restx.reqparse.RequestParser()# TODO better way to call this?
         # TODO document these options
-        parser.add_argument('type', choices=('wakeup',), default='wakeup') # TODO - allow this to be all and then spec in results
+        parser.add_argument('type', choices=TIMELINE_KINDS, default='wakeup') # TODO - allow this to be all and then spec in results
+        parser.add_argument('context', choices=CTX)
         args = parser.parse_args()
-        assert args['type'] == 'wakeup'
-        result = Task.query.with_entities(Task.wakeup,
-                                          db.func.count(Task.wakeup)).group_by(Task.wakeup).filter(Task.closed == None,
-                                                                                                   Task.wakeup >= datetime.datetime.now()).order_by(db.func.count(Task.wakeup).desc()).all()
-        return [{'timeline': x[0], 'count': x[1]} for x in result]
+        now = datetime.datetime.now()
+        if db.engine.dialect.name != 'sqlite':
+            column = getattr(Task, args['type'])
+            criteria = [Task.closed == None, column >= now]
+            if args['context']:
+                criteria.append(Task.context == args['context'])
+            count = db.func.count(column)
+            query = db.select(column.label('at'), count.label('count')).where(*criteria).group_by(column)
+        else:
+            criteria = [Timeline.kind == args['type'], Timeline.at >= now]
+            if args['context']:
+                criteria.append(Timeline.context == args['context'])
+            count = db.func.sum(Timeline.count)
+            query = db.select(Timeline.at, count.label('count')).where(*criteria).group_by(Timeline.at)
+        return db.session.execute(query.order_by(count.desc(), 'at')).mappings().all()
 
 
 @ctxns.route('/')
@@ -347,13 +705,29 @@ class ContextList(flask_restx.Resource):
     def get(self):
         return CTX
 
-# TODO get similar to task ID x
-# TODO search for string in name, desc, etc
+# TODO search for string in desc, etc
 # TODO search for tags
 
 
-db.create_all()
-
+with app.app_context():
+    if app.config.get('METRICS'):
+        metrics.watch(db.engine)
+    db.create_all()
+    # create_all() skips tables that exist, so add any columns and indexes missing from older DBs
+    if 'seq' not in {x['name'] for x in db.inspect(db.engine).get_columns('task')}:
+        with db.engine.begin() as connection:
+            connection.execute(db.text("ALTER TABLE task ADD COLUMN seq INTEGER"))
+    for index in Task.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.begin() as connection:
+            if not db.inspect(connection).has_table('task_fts'):
+                for ddl in SEARCH_DDL:
+                    connection.execute(db.text(ddl))
+            if not connection.execute(db.text("SELECT 1 FROM sqlite_master "
+                                              "WHERE type = 'trigger' AND name = 'timeline_insert'")).first():
+                for ddl in TIMELINE_DDL:
+                    connection.execute(db.text(ddl))
 
 if __name__ == '__main__':
     app.run()